@@ -0,0 +1,37 @@
+import argparse
+import csv
+import random
+import sys
+
+# Synthetic inventory CSVs for the benchmarks. Keys are SKU00000000,
+# SKU00000001, ... so the first --seed-records keys given to
+# mock_csi_server.py already exist on the server.
+
+HEADERS = ["Code", "Name", "Qty", "Price"]
+FIELD_MAPPINGS = {"Code": "code", "Name": "name", "Qty": "qty", "Price": "price"}
+API_FIELDS = {"code": "str", "name": "str", "qty": "int", "price": "float", "id": "str"}
+
+
+def generate_csv(path, rows, bad_rate=0.0, seed=1):
+    rng = random.Random(seed)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADERS)
+        for i in range(rows):
+            qty = "n/a" if bad_rate and rng.random() < bad_rate else str(rng.randrange(1000))
+            writer.writerow([f"SKU{i:08d}", f"Item {i}", qty, f"{rng.uniform(1, 500):.2f}"])
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic inventory CSV.")
+    parser.add_argument("path")
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--bad-rate", type=float, default=0.0, help="fraction of rows with a bad Qty cell")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    generate_csv(args.path, args.rows, args.bad_rate, args.seed)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
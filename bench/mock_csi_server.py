@@ -0,0 +1,215 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-in for the CSI request handler, for benchmarks. Implements
+#   POST /csi-requesthandler/api/v2/session
+#   GET  /csi-requesthandler/api/v2/{endpoint}[?field=value[&field=value2..]][&skip=&limit=]
+#   POST /csi-requesthandler/api/v2/{endpoint}
+#   PUT  /csi-requesthandler/api/v2/{endpoint}/{id}
+#   PUT  /csi-requesthandler/api/v2/{endpoint}  (array of records with "id")
+# with configurable latency, 5xx/429 injection, expiring session tokens
+# (401 once a token is older than --session-ttl) and a pre-seeded dataset.
+
+API_PREFIX = "/csi-requesthandler/api/v2/"
+
+
+class Store:
+    # records by id plus an index on the key field so ?code=... stays O(1)
+
+    def __init__(self, key_field):
+        self.key_field = key_field
+        self.lock = threading.Lock()
+        self.records = {}
+        self.by_key = {}
+        self.next_id = 1
+
+    def seed(self, count):
+        for i in range(count):
+            self.create({self.key_field: f"SKU{i:08d}", "name": f"Item {i}", "qty": i % 500, "price": 9.99})
+
+    def create(self, record):
+        with self.lock:
+            record = dict(record, id=f"C{self.next_id}")
+            self.next_id += 1
+            self.records[record["id"]] = record
+            self.by_key.setdefault(str(record.get(self.key_field)), record["id"])
+            return record
+
+    def update(self, record_id, changes):
+        with self.lock:
+            record = self.records.get(record_id)
+            if record is None:
+                return None
+            record.update(changes)
+            return record
+
+    def query(self, filters, skip, limit):
+        # filters: field -> accepted values (a repeated field matches any)
+        with self.lock:
+            if list(filters) == [self.key_field]:
+                record_ids = [self.by_key.get(v) for v in filters[self.key_field]]
+                matches = [self.records[record_id] for record_id in record_ids if record_id]
+            else:
+                matches = [r for r in self.records.values()
+                           if all(str(r.get(k)) in v for k, v in filters.items())]
+            end = skip + limit if limit is not None else None
+            return matches[skip:end]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # send headers and body in one segment; split writes on a keep-alive
+    # connection stall on delayed ACKs and swamp the numbers
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+    store = None
+    options = None
+    sessions = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def unauthorized(self):
+        # only enforced with a session ttl; tokens are the Cookie header
+        ttl = self.options.session_ttl
+        if not ttl:
+            return False
+        issued = self.sessions.get(self.headers.get("Cookie"))
+        if issued is not None and time.monotonic() - issued < ttl:
+            return False
+        self.send_json(401, {"error": "session expired"})
+        return True
+
+    def new_session(self):
+        token = f"SecurityTokenURL=bench-{len(self.sessions) + 1}"
+        self.sessions[token] = time.monotonic()
+        return token
+
+    def injected_failure(self):
+        # simulated latency and server trouble, applied to every data call
+        opts = self.options
+        if opts.latency_ms:
+            time.sleep(random.uniform(0.5, 1.5) * opts.latency_ms / 1000)
+        roll = random.random()
+        if roll < opts.error_rate:
+            self.send_json(503, {"error": "injected"})
+            return True
+        if roll < opts.error_rate + opts.throttle_rate:
+            self.send_json(429, {"error": "slow down"}, {"Retry-After": str(opts.retry_after)})
+            return True
+        return False
+
+    def route(self):
+        path = urlparse(self.path).path
+        if not path.startswith(API_PREFIX):
+            return None, None
+        parts = path[len(API_PREFIX):].strip("/").split("/")
+        return parts[0], (parts[1] if len(parts) > 1 else None)
+
+    def do_GET(self):
+        endpoint, _ = self.route()
+        if endpoint is None:
+            return self.send_json(404, {"error": "not found"})
+        self.read_json()  # drain anything a client sent
+        if self.unauthorized() or self.injected_failure():
+            return
+        query = parse_qs(urlparse(self.path).query)
+        skip = int(query.pop("skip", ["0"])[0])
+        limit = int(query.pop("limit")[0]) if "limit" in query else None
+        self.send_json(200, self.store.query(query, skip, limit))
+
+    def do_POST(self):
+        endpoint, _ = self.route()
+        body = self.read_json()
+        if endpoint == "session":
+            return self.send_json(200, {"token": self.new_session()})
+        if endpoint is None:
+            return self.send_json(404, {"error": "not found"})
+        if self.unauthorized() or self.injected_failure():
+            return
+        if isinstance(body, list):
+            return self.send_json(201, [self.store.create(item) for item in body])
+        self.send_json(201, self.store.create(body))
+
+    def do_PUT(self):
+        endpoint, record_id = self.route()
+        body = self.read_json()
+        if endpoint is None:
+            return self.send_json(404, {"error": "not found"})
+        if self.unauthorized() or self.injected_failure():
+            return
+        if record_id is None:
+            if not isinstance(body, list):
+                return self.send_json(400, {"error": "expected an array"})
+            results = []
+            for item in body:
+                record = self.store.update(item.get("id"), item)
+                results.append(record if record is not None else {"error": f"no record {item.get('id')}"})
+            return self.send_json(200, results)
+        record = self.store.update(record_id, body)
+        if record is None:
+            return self.send_json(404, {"error": f"no record {record_id}"})
+        self.send_json(200, record)
+
+
+def start_server(port=0, key_field="code", seed_records=0, latency_ms=0.0,
+                 error_rate=0.0, throttle_rate=0.0, retry_after=1, session_ttl=0.0):
+    options = argparse.Namespace(latency_ms=latency_ms, error_rate=error_rate,
+                                 throttle_rate=throttle_rate, retry_after=retry_after,
+                                 session_ttl=session_ttl)
+    store = Store(key_field)
+    store.seed(seed_records)
+    handler = type("BenchHandler", (Handler,), {"store": store, "options": options, "sessions": {}})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mock CSI request handler for benchmarks.")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--key-field", default="code")
+    parser.add_argument("--seed-records", type=int, default=0,
+                        help="records SKU00000000.. that already exist")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="mean added latency per call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of calls answered 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429")
+    parser.add_argument("--session-ttl", type=float, default=0.0,
+                        help="seconds a login token stays valid (0 = never checked)")
+    args = parser.parse_args(argv)
+
+    server = start_server(args.port, args.key_field, args.seed_records, args.latency_ms,
+                          args.error_rate, args.throttle_rate, args.retry_after, args.session_ttl)
+    # the benchmark runner reads the port from this line
+    print(f"PORT {server.server_port}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
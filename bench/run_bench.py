@@ -0,0 +1,166 @@
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from inv_core import UpsertEngine  # noqa: E402
+from gen_csv import API_FIELDS, FIELD_MAPPINGS, generate_csv  # noqa: E402
+
+# End-to-end upsert benchmark. For each size it starts mock_csi_server.py,
+# generates a CSV, runs the headless engine in a fresh process (so peak RSS
+# is per run) and reports rows/sec, p50/p99 per-row latency and peak RSS.
+# Results are printed and appended to bench_output.txt in the repo root.
+
+OUTPUT_FILE = os.path.join(os.path.dirname(BENCH_DIR), "bench_output.txt")
+
+
+class TimedEngine(UpsertEngine):
+    # keeps exact per-row latencies; the engine's own histograms are bucketed
+
+    def __init__(self, config_data):
+        super().__init__(config_data)
+        self.latencies = array('d')
+
+    def log_result(self, row_index, status, error, action, record_id=None):
+        started = self.row_started.get(row_index)
+        if started is not None:
+            self.latencies.append(time.perf_counter() - started)
+        super().log_result(row_index, status, error, action, record_id)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def run_worker(args):
+    config = {
+        "base_url": args.url,
+        "endpoint": "items",
+        "key_column": "Code",
+        "field_mappings": dict(FIELD_MAPPINGS),
+        "duplicate_policy": "update",
+        "max_workers": args.workers,
+        "http_pool_size": args.workers,
+        "key_lookup_mode": args.lookup,
+        "batch_size": args.batch_size,
+        "journal_enabled": False,
+        "metrics_export": False,
+        "backoff_factor": 0.05,
+    }
+    with contextlib.redirect_stdout(sys.stderr):
+        engine = TimedEngine(config)
+        engine.results_path = os.devnull
+        engine.login("bench", "bench")
+        engine.api_fields = dict(API_FIELDS)
+        started = time.perf_counter()
+        engine.run(args.csv)
+        elapsed = time.perf_counter() - started
+        engine.close_http_session()
+
+    latencies = sorted(engine.latencies)
+    summary = engine.summary()
+    result = {
+        "rows": summary["total"],
+        "fail": summary["fail"],
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(summary["total"] / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        # ru_maxrss is KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "retries": sum(engine.metrics.retries.values()),
+    }
+    print(json.dumps(result))
+
+
+def start_mock_server(args, seed_records):
+    cmd = [sys.executable, os.path.join(BENCH_DIR, "mock_csi_server.py"),
+           "--seed-records", str(seed_records),
+           "--latency-ms", str(args.latency_ms),
+           "--error-rate", str(args.error_rate),
+           "--throttle-rate", str(args.throttle_rate)]
+    server = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    port_line = server.stdout.readline().split()
+    if len(port_line) != 2 or port_line[0] != "PORT":
+        server.kill()
+        raise RuntimeError("mock server did not start")
+    return server, f"http://127.0.0.1:{port_line[1]}"
+
+
+def run_size(args, rows, workdir):
+    csv_path = generate_csv(os.path.join(workdir, f"bench_{rows}.csv"), rows, args.bad_rate)
+    server, url = start_mock_server(args, int(rows * args.existing))
+    try:
+        cmd = [sys.executable, os.path.abspath(__file__), "--worker", "--csv", csv_path,
+               "--url", url, "--workers", str(args.workers), "--lookup", args.lookup,
+               "--batch-size", str(args.batch_size)]
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, text=True, check=True).stdout
+    finally:
+        server.terminate()
+        server.wait()
+    result = json.loads(out.strip().splitlines()[-1])
+    result["size"] = rows
+    return result
+
+
+def format_report(args, results):
+    lines = [
+        f"# upsert benchmark {time.strftime('%Y-%m-%d %H:%M:%S')} "
+        f"workers={args.workers} lookup={args.lookup} batch_size={args.batch_size} latency_ms={args.latency_ms} "
+        f"error_rate={args.error_rate} throttle_rate={args.throttle_rate} existing={args.existing}",
+        f"{'size':>9} {'rows/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'rss MB':>8} {'retries':>8} {'fail':>6}",
+    ]
+    for r in results:
+        lines.append(f"{r['size']:>9} {r['rows_per_second']:>9} {r['p50_ms']:>8} {r['p99_ms']:>8} "
+                     f"{r['peak_rss_mb']:>8} {r['retries']:>8} {r['fail']:>6}")
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the upsert pipeline against a local mock server.")
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="comma-separated row counts")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--lookup", choices=("prefetch", "per_row"), default="prefetch")
+    parser.add_argument("--batch-size", type=int, default=0, help="rows per create/update request (0 = one)")
+    parser.add_argument("--existing", type=float, default=0.5, help="fraction of keys already on the server")
+    parser.add_argument("--bad-rate", type=float, default=0.0, help="fraction of rows with a bad cell")
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--output", default=OUTPUT_FILE, help="report is appended here")
+    # internal: one measured run in a child process
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--csv", help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        run_worker(args)
+        return 0
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in [int(s) for s in args.sizes.split(",") if s]:
+            results.append(run_size(args, size, workdir))
+            print(f"{size} rows: {results[-1]}", file=sys.stderr)
+
+    report = format_report(args, results)
+    print(report, end="")
+    with open(args.output, "a", encoding="utf-8") as f:
+        f.write(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
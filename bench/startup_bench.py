@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# Cold-start benchmark for the app. Each run is a fresh interpreter started
+# in an empty directory (so no saved config is read) that times importing
+# inv_core and inv_app and how long MappingApp takes to draw its first
+# frame. Reports medians; results are appended to bench_output.txt.
+
+OUTPUT_FILE = os.path.join(REPO_DIR, "bench_output.txt")
+
+
+def run_child():
+    started = time.perf_counter()
+    sys.path.insert(0, REPO_DIR)
+    os.environ.setdefault("KIVY_NO_ARGS", "1")
+    os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+    import inv_core  # noqa: F401
+    core_loaded = time.perf_counter()
+    import inv_app
+    app_loaded = time.perf_counter()
+
+    from kivy.clock import Clock
+    from kivy.core.window import Window
+
+    result = {
+        "import_core_ms": (core_loaded - started) * 1000,
+        "import_app_ms": (app_loaded - core_loaded) * 1000,
+        "requests_loaded": "requests" in sys.modules,
+    }
+    app = inv_app.MappingApp()
+
+    def on_flip(*args):
+        Window.unbind(on_flip=on_flip)
+        result["first_frame_ms"] = (time.perf_counter() - started) * 1000
+        Clock.schedule_once(lambda dt: app.stop(), 0)
+
+    Window.bind(on_flip=on_flip)
+    app.run()
+    print("RESULT " + json.dumps(result), flush=True)
+
+
+def run_once(workdir):
+    started = time.perf_counter()
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"], cwd=workdir,
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True).stdout
+    wall_ms = (time.perf_counter() - started) * 1000
+    for line in out.splitlines():
+        if line.startswith("RESULT "):
+            result = json.loads(line[len("RESULT "):])
+            result["process_ms"] = wall_ms
+            return result
+    raise RuntimeError("startup child did not report a result")
+
+
+def format_report(runs):
+    def median(key):
+        return round(statistics.median(r[key] for r in runs), 1)
+
+    return (
+        f"# startup benchmark {time.strftime('%Y-%m-%d %H:%M:%S')} runs={len(runs)}\n"
+        f"{'import core ms':>15} {'import app ms':>14} {'first frame ms':>15} {'process ms':>11} requests@import\n"
+        f"{median('import_core_ms'):>15} {median('import_app_ms'):>14} {median('first_frame_ms'):>15} "
+        f"{median('process_ms'):>11} {any(r['requests_loaded'] for r in runs)}\n"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure app import time and first-frame latency.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", default=OUTPUT_FILE, help="report is appended here")
+    # internal: one measured start in a child process
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        run_child()
+        return 0
+
+    with tempfile.TemporaryDirectory() as workdir:
+        runs = [run_once(workdir) for _ in range(args.runs)]
+
+    report = format_report(runs)
+    print(report, end="")
+    with open(args.output, "a", encoding="utf-8") as f:
+        f.write(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
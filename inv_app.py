@@ -1,37 +1,48 @@
 import kivy
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.label import Label
 from kivy.uix.button import Button
-from kivy.uix.filechooser import FileChooserListView
 from kivy.uix.textinput import TextInput
-from kivy.uix.spinner import Spinner
-from kivy.uix.popup import Popup
-import csv
-import requests
-import json
-import os
-import time
+import threading
+
+import inv_core
+from inv_core import UpsertEngine
+
+# Only what the login screen needs is imported up front. Other widgets
+# (file chooser, spinners, popups, the mapping RecycleView) and requests
+# are imported by the screen that first uses them.
+
+# labels for the "if key exists" spinner, keyed by duplicate_policy
+POLICY_LABELS = {
+    "ask": "Ask for each row",
+    "update": "Always update",
+    "create": "Always create new",
+    "skip": "Skip existing",
+}
+
+# a Spinner builds a button per value up front, so the key column spinner
+# only offers this many headers that match the filter box
+MAX_KEY_CHOICES = 50
+
+SKIP_FIELD = "Skip Field"
+UNMAPPED = "Select API Field"
+
 
 class MappingApp(App):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         # We'll store & load config from this file
-        self.config_filename = "mapping_config.json"
+        self.config_filename = inv_core.CONFIG_FILENAME
         # load config at startup
         self.config_data = self.load_config()
-        self.base_url = self.config_data.get("base_url", "")
         self.saved_username = self.config_data.get("username", "")
-        self.endpoint = self.config_data.get("endpoint", "")
-        self.key_column = self.config_data.get("key_column", None)
-        self.field_mappings = self.config_data.get("field_mappings", {})
         self.csv_headers = []
-        self.session_token = None
-        self.rows_to_process = []
-        self.current_row_index = 0
-        self.api_fields = {}
-        self.results_log = []
+        # config, HTTP, payloads and results live in the Kivy-free engine
+        self.engine = UpsertEngine(self.config_data, self.config_filename)
+        self.engine.ask_existing = self.ask_update_or_create
 
     def build(self):
         return self.login_screen()
@@ -51,8 +62,8 @@ class MappingApp(App):
             font_size=32
         )
        
-        if self.base_url:
-            self.base_url_input.text = self.base_url
+        if self.engine.base_url:
+            self.base_url_input.text = self.engine.base_url
         layout.add_widget(self.base_url_input)
 
         layout.add_widget(Label(text="Username", font_size=40, color=(1, 1, 1, 1)))
@@ -93,46 +104,38 @@ class MappingApp(App):
         return layout
 
     def authenticate(self, instance):
+        import requests
+
         entered_url = self.base_url_input.text.strip()
         if not entered_url:
             self.show_popup("Error", "Please enter a valid base URL.")
             return
-        self.base_url = entered_url
+        self.engine.base_url = entered_url
 
         username = self.username_input.text.strip()
         password = self.password_input.text.strip()
 
-        login_url = f"{self.base_url}/csi-requesthandler/api/v2/session"
-
         try:
-            response = requests.post(
-                login_url,
-                json={"username": username, "password": password},
-                headers={"accept": "application/json", "Content-Type": "application/json"}
-            )
-            if response.status_code == 200:
-                token = response.json().get('token')
-                if not token:
-                    raise ValueError("Token not found in the login response.")
-                self.session_token = token
-                self.show_popup("Success", "Login successful!")
-
-               
-                self.config_data["base_url"] = self.base_url
-                self.config_data["username"] = username
-               
-
-                self.root.clear_widgets()
-                # If we already had an endpoint saved could skip or show next screen
-                if self.endpoint:
-                    # Possibly skip endpoint input
-                    self.root.add_widget(self.upload_screen())
-                else:
-                    #normal flow
-                    self.root.add_widget(self.upload_screen())
+            # always asks the server, so success means the password is right
+            self.engine.login(username, password, use_cache=False)
+            self.show_popup("Success", "Login successful!")
 
+           
+            self.config_data["base_url"] = self.engine.base_url
+            self.config_data["username"] = username
+           
+
+            self.root.clear_widgets()
+            # If we already had an endpoint saved could skip or show next screen
+            if self.engine.endpoint:
+                # Possibly skip endpoint input
+                self.root.add_widget(self.upload_screen())
             else:
-                self.show_popup("Error", f"Login failed: {response.text}")
+                #normal flow
+                self.root.add_widget(self.upload_screen())
+
+        except ValueError as e:
+            self.show_popup("Error", str(e))
         except requests.exceptions.RequestException as e:
             self.show_popup("Error", f"Failed to connect: {e}")
 
@@ -140,6 +143,8 @@ class MappingApp(App):
      #UPLOAD SCREEN
    
     def upload_screen(self):
+        from kivy.uix.filechooser import FileChooserListView
+
         layout = BoxLayout(orientation='vertical', padding=50, spacing=50)
 
         layout.add_widget(Label(text="Upload CSV File", font_size=36, color=(0, 0, 0, 1)))
@@ -158,6 +163,19 @@ class MappingApp(App):
         upload_button.bind(on_press=self.upload_csv)
         layout.add_widget(upload_button)
 
+        profiles = self.config_data.get("profiles", {})
+        if profiles:
+            jobs_button = Button(
+                text=f"Run Saved Jobs ({len(profiles)})",
+                size_hint_y=None,
+                height=80,
+                background_normal='',
+                background_color=(0, 0.6, 0.3, 1),
+                font_size=28
+            )
+            jobs_button.bind(on_press=lambda x: self.show_jobs_screen())
+            layout.add_widget(jobs_button)
+
         logout_button = Button(
             text="Logout",
             size_hint_y=None,
@@ -178,14 +196,13 @@ class MappingApp(App):
 
         file_path = self.file_chooser.selection[0]
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                self.csv_headers = reader.fieldnames or []
+            self.csv_headers = self.engine.read_csv_headers(file_path)
+            self.engine.csv_path = file_path
             self.show_popup("Success", "File uploaded successfully!")
 
             self.root.clear_widgets()
             
-            if self.endpoint:
+            if self.engine.endpoint:
                 # skip or show mapping
                 self.root.add_widget(self.endpoint_input_screen(skip_if_pre_filled=True))
             else:
@@ -200,7 +217,7 @@ class MappingApp(App):
     def endpoint_input_screen(self, skip_if_pre_filled=False):
         layout = BoxLayout(orientation='vertical', padding=50, spacing=50)
 
-        if skip_if_pre_filled and self.endpoint:
+        if skip_if_pre_filled and self.engine.endpoint:
            
             pass
 
@@ -210,8 +227,8 @@ class MappingApp(App):
             multiline=False,
             font_size=24
         )
-        if self.endpoint:
-            self.endpoint_input.text = self.endpoint  # pre-fill
+        if self.engine.endpoint:
+            self.endpoint_input.text = self.engine.endpoint  # pre-fill
 
         layout.add_widget(self.endpoint_input)
 
@@ -226,36 +243,41 @@ class MappingApp(App):
         submit_button.bind(on_press=self.fetch_api_fields)
         layout.add_widget(submit_button)
 
+        # bypasses the cached field list, e.g. after the endpoint changed
+        refresh_button = Button(
+            text="Refresh API Fields",
+            size_hint_y=None,
+            height=80,
+            background_normal='',
+            background_color=(0.4, 0.4, 0.4, 1),
+            font_size=24
+        )
+        refresh_button.bind(on_press=lambda instance: self.fetch_api_fields(instance, refresh=True))
+        layout.add_widget(refresh_button)
+
         return layout
 
-    def fetch_api_fields(self, instance):
+    def fetch_api_fields(self, instance, refresh=False):
+        import requests
+
         endpoint_str = self.endpoint_input.text.strip()
         if not endpoint_str:
             self.show_popup("Error", "Please enter a valid endpoint.")
             return
-        self.endpoint = endpoint_str
-
-        full_url = f"{self.base_url}/csi-requesthandler/api/v2/{self.endpoint}"
-        headers = {"accept": "application/json", "Cookie": self.session_token}
+        self.engine.endpoint = endpoint_str
 
         try:
-            resp = requests.get(full_url, headers=headers)
-            if resp.status_code == 200:
-                data = resp.json()
-                if isinstance(data, list) and len(data) > 0:
-                    self.api_fields = {k: type(v).__name__ for k, v in data[0].items()}
-                    self.show_popup("Success", "API fields and types fetched successfully!")
-                    
-                    self.config_data["endpoint"] = self.endpoint
-                    
-                    # Clear the current screen
-                    self.root.clear_widgets()
-                    # Always show the mapping screen
-                    self.root.add_widget(self.show_key_and_mapping_screen())
-                else:
-                    self.show_popup("Error", "No data found at the endpoint to deduce fields.")
-            else:
-                self.show_popup("Error", f"Failed to fetch data: {resp.status_code} - {resp.text}")
+            self.engine.fetch_api_fields(refresh=refresh)
+            self.show_popup("Success", "API fields and types fetched successfully!")
+            
+            self.config_data["endpoint"] = self.engine.endpoint
+            
+            # Clear the current screen
+            self.root.clear_widgets()
+            # Always show the mapping screen
+            self.root.add_widget(self.show_key_and_mapping_screen())
+        except ValueError as e:
+            self.show_popup("Error", str(e))
         except requests.exceptions.RequestException as e:
             self.show_popup("Error", f"Error fetching endpoint: {e}")
 
@@ -264,6 +286,9 @@ class MappingApp(App):
     #KEY COLUMN/MAPPING SCREEN
     
     def show_key_and_mapping_screen(self):
+        from kivy.uix.spinner import Spinner
+        from inv_mapping_view import mapping_view
+
         layout = BoxLayout(orientation='vertical', spacing=20, padding=20)
 
         layout.add_widget(Label(text="Select Key Column and Map Fields (or Skip)", font_size=24))
@@ -272,38 +297,47 @@ class MappingApp(App):
         key_row.add_widget(Label(text="Key Column:", size_hint_x=0.3))
         self.key_column_spinner = Spinner(
             text="Select Key Column",
-            values=self.csv_headers,
+            values=self.csv_headers[:MAX_KEY_CHOICES],
             size_hint_x=0.7
         )
         key_row.add_widget(self.key_column_spinner)
         layout.add_widget(key_row)
 
-        if self.key_column and self.key_column in self.csv_headers:
+        if self.engine.key_column and self.engine.key_column in self.csv_headers:
             # pre-select saved key column
-            self.key_column_spinner.text = self.key_column
-
-        layout.add_widget(Label(text="Map CSV Headers to API Fields", font_size=20))
-
-        self.field_map_dropdowns = {}
-        spinner_choices = list(self.api_fields.keys()) + ["Skip Field"]
+            self.key_column_spinner.text = self.engine.key_column
 
-        for csv_header in self.csv_headers:
-            row = BoxLayout(orientation='horizontal', size_hint_y=None, height=40)
-            row.add_widget(Label(text=csv_header, size_hint_x=0.3))
-
-            dropdown = Spinner(
-                text="Select API Field",
-                values=spinner_choices,
-                size_hint_x=0.7
-            )
-            self.field_map_dropdowns[csv_header] = dropdown
-            row.add_widget(dropdown)
-            layout.add_widget(row)
-
-            
-            saved_field = self.field_mappings.get(csv_header)
-            if saved_field:
-                dropdown.text = saved_field
+        policy_row = BoxLayout(orientation='horizontal', size_hint_y=None, height=40)
+        policy_row.add_widget(Label(text="If Key Exists:", size_hint_x=0.3))
+        self.policy_spinner = Spinner(
+            text=POLICY_LABELS.get(self.engine.duplicate_policy, POLICY_LABELS["ask"]),
+            values=list(POLICY_LABELS.values()),
+            size_hint_x=0.7
+        )
+        policy_row.add_widget(self.policy_spinner)
+        layout.add_widget(policy_row)
+
+        layout.add_widget(Label(text="Map CSV Headers to API Fields", font_size=20, size_hint_y=None, height=40))
+
+        # saved mappings win, the rest is guessed from the header names
+        suggestions = inv_core.suggest_mappings(self.csv_headers, self.engine.api_fields,
+                                                self.engine.field_mappings)
+        self.mapping_choices = {h: suggestions.get(h, UNMAPPED) for h in self.csv_headers}
+        self.mapping_field_choices = list(self.engine.api_fields.keys()) + [SKIP_FIELD]
+
+        filter_row = BoxLayout(orientation='horizontal', size_hint_y=None, height=40)
+        self.mapping_filter = TextInput(hint_text="Filter columns...", multiline=False, size_hint_x=0.7)
+        self.mapping_filter.bind(text=lambda instance, text: self.refresh_mapping_rows())
+        filter_row.add_widget(self.mapping_filter)
+        filter_row.add_widget(Label(
+            text=f"{len(suggestions)} of {len(self.csv_headers)} matched",
+            size_hint_x=0.3
+        ))
+        layout.add_widget(filter_row)
+
+        self.mapping_view = mapping_view()
+        layout.add_widget(self.mapping_view)
+        self.refresh_mapping_rows()
 
         save_button = Button(
             text="Save and Proceed",
@@ -313,54 +347,85 @@ class MappingApp(App):
         save_button.bind(on_press=self.handle_key_column_and_mapping)
         layout.add_widget(save_button)
 
+        dry_run_button = Button(
+            text="Dry Run (Plan Only)",
+            size_hint_y=None,
+            height=50
+        )
+        dry_run_button.bind(on_press=lambda x: self.handle_key_column_and_mapping(x, dry_run=True))
+        layout.add_widget(dry_run_button)
+
         return layout
 
-    def handle_key_column_and_mapping(self, instance):
+    def refresh_mapping_rows(self):
+        text = self.mapping_filter.text.strip().lower()
+        matching = [h for h in self.csv_headers if not text or text in h.lower()]
+        self.key_column_spinner.values = matching[:MAX_KEY_CHOICES]
+        self.mapping_view.data = [
+            {"csv_header": h, "api_field": api_field, "choices": self.mapping_field_choices}
+            for h, api_field in self.mapping_choices.items()
+            if not text or text in h.lower() or text in api_field.lower()
+        ]
+
+    def set_mapping_choice(self, csv_header, api_field):
+        self.mapping_choices[csv_header] = api_field
+        # keep the row's data in step so scrolling back shows the choice
+        for entry in self.mapping_view.data:
+            if entry["csv_header"] == csv_header:
+                entry["api_field"] = api_field
+                break
+
+    def handle_key_column_and_mapping(self, instance, dry_run=False):
         chosen_key = self.key_column_spinner.text.strip()
         if chosen_key not in self.csv_headers:
             self.show_popup("Error", "Please select a valid key column.")
             return
 
-        if not self.check_for_duplicates(chosen_key):
+        if self.engine.duplicate_check == "prescan" and not self.check_for_duplicates(chosen_key):
             return
-        self.key_column = chosen_key
+        self.engine.key_column = chosen_key
 
         temp_mappings = {}
-        for csv_header, spinner_widget in self.field_map_dropdowns.items():
-            api_field = spinner_widget.text
-            if api_field not in ("Skip Field", "Select API Field"):
+        for csv_header, api_field in self.mapping_choices.items():
+            if api_field not in (SKIP_FIELD, UNMAPPED):
                 temp_mappings[csv_header] = api_field
 
         if not temp_mappings:
             self.show_popup("Error", "No fields mapped! Please map at least one field.")
             return
 
-        self.field_mappings = temp_mappings
+        self.engine.field_mappings = temp_mappings
+        for policy, label in POLICY_LABELS.items():
+            if label == self.policy_spinner.text:
+                self.engine.duplicate_policy = policy
 
-        self.show_popup("Success", f"Key column '{self.key_column}' and mappings saved!")
+        self.show_popup("Success", f"Key column '{self.engine.key_column}' and mappings saved!")
         # Store in config
-        self.config_data["key_column"] = self.key_column
-        self.config_data["field_mappings"] = self.field_mappings
+        self.config_data["key_column"] = self.engine.key_column
+        self.config_data["field_mappings"] = self.engine.field_mappings
+        self.config_data["duplicate_policy"] = self.engine.duplicate_policy
 
-        self.start_csv_processing()
+        if dry_run:
+            self.begin_planning()
+        else:
+            self.start_csv_processing()
 
     def check_for_duplicates(self, column_name):
-        try:
-            file_path = self.file_chooser.selection[0]
-        except (IndexError, AttributeError):
+        if not self.engine.csv_path:
             self.show_popup("Error", "No CSV file selected for duplicates check.")
             return False
 
-        seen = set()
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    val = row.get(column_name, "")
-                    if val in seen:
-                        self.show_popup("Error", f"Duplicate '{val}' found in column '{column_name}'.")
-                        return False
-                    seen.add(val)
+            # every duplicate at once, so they can all be fixed in one go;
+            # processing reuses the scan instead of tracking keys again
+            scan = self.engine.scan_keys(self.engine.csv_path, column_name)
+            if scan.duplicates:
+                self.show_popup(
+                    "Error",
+                    f"{len(scan.duplicates)} duplicate values in column '{column_name}':\n{scan.describe()}"
+                )
+                return False
+            self.engine.key_scan = scan
         except Exception as e:
             self.show_popup("Error", f"Failed reading CSV: {e}")
             return False
@@ -371,93 +436,202 @@ class MappingApp(App):
     #PROCESS CSV
    
     def start_csv_processing(self):
-        try:
-            file_path = self.file_chooser.selection[0]
-        except (IndexError, AttributeError):
+        if not self.engine.csv_path:
             self.show_popup("Error", "No CSV file selected.")
             return
 
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                self.rows_to_process = list(reader)
+            journaled = self.engine.journaled_row_count(self.engine.csv_path)
+        except Exception as e:
+            print(f"Could not read journal: {e}")
+            journaled = 0
+        if journaled:
+            self.show_resume_popup(journaled)
+        else:
+            self.begin_processing(resume=False)
+
+    def show_resume_popup(self, journaled):
+        from kivy.uix.popup import Popup
+
+        layout = BoxLayout(orientation='vertical', spacing=10, padding=10)
+        msg = (
+            f"A previous run of this file already finished {journaled} rows.\n"
+            "Resume and skip them, or start over?"
+        )
+        layout.add_widget(Label(text=msg, size_hint_y=None, height=80))
+
+        button_box = BoxLayout(orientation='horizontal', spacing=10, size_hint_y=None, height=50)
+        resume_btn = Button(text="Resume")
+        restart_btn = Button(text="Start Over")
+        button_box.add_widget(resume_btn)
+        button_box.add_widget(restart_btn)
+        layout.add_widget(button_box)
+
+        popup = Popup(
+            title="Resume Import?",
+            content=layout,
+            size_hint=(0.6, 0.4),
+            auto_dismiss=False
+        )
+
+        def on_resume(instance):
+            popup.dismiss()
+            self.begin_processing(resume=True)
+
+        def on_restart(instance):
+            popup.dismiss()
+            self.begin_processing(resume=False)
+
+        resume_btn.bind(on_press=on_resume)
+        restart_btn.bind(on_press=on_restart)
+        popup.open()
+
+    def begin_processing(self, resume):
+        self.root.clear_widgets()
+        self.root.add_widget(self.processing_screen())
+        # network I/O and retry backoff stay off the Kivy main thread
+        worker = threading.Thread(target=self.run_processing, args=(resume,), daemon=True)
+        worker.start()
+
+    def processing_screen(self):
+        layout = BoxLayout(orientation='vertical', spacing=10, padding=10)
+        self.progress_label = Label(text="Preparing import...", font_size=24)
+        layout.add_widget(self.progress_label)
+        self.progress_detail_label = Label(text="", font_size=18)
+        layout.add_widget(self.progress_detail_label)
+
+        # the engine only bumps counters; the screen samples them at a fixed
+        # rate however fast rows finish
+        self.progress_meter = inv_core.ProgressMeter()
+        self.progress_event = Clock.schedule_interval(
+            self.refresh_progress, self.config_data.get("progress_refresh_seconds", 0.5)
+        )
+
+        metrics_button = Button(text="Show Metrics", size_hint_y=None, height=50)
+        metrics_button.bind(on_press=lambda x: self.show_metrics_popup())
+        layout.add_widget(metrics_button)
+        return layout
+
+    def show_metrics_popup(self):
+        from kivy.uix.popup import Popup
+
+        metrics_label = Label(text=self.engine.metrics.describe())
+        popup = Popup(title="Metrics", content=metrics_label, size_hint=(0.8, 0.6))
 
-            self.current_row_index = 0
-            self.results_log.clear()
-            self.process_next_row()
+        # refresh once a second while the popup is open
+        def refresh(dt):
+            metrics_label.text = self.engine.metrics.describe()
+
+        refresh_event = Clock.schedule_interval(refresh, 1.0)
+        popup.bind(on_dismiss=lambda x: refresh_event.cancel())
+        popup.open()
+
+    def refresh_progress(self, dt):
+        progress = self.progress_meter.sample(self.engine.progress())
+        if progress["rows_total"]:
+            done = f"{progress['rows_done']} / {progress['rows_total']} rows"
+        elif progress["fraction_done"] is not None:
+            done = f"{progress['rows_done']} rows ({progress['fraction_done']:.0%} of the file read)"
+        else:
+            done = f"{progress['rows_done']} rows"
+        self.progress_label.text = f"Processed {done}"
+
+        rate = progress["rows_per_second"]
+        eta = progress["eta_seconds"]
+        self.progress_detail_label.text = (
+            f"{rate:.1f} rows/sec" if rate is not None else "-- rows/sec"
+        ) + (
+            f"  |  ETA {int(eta // 60)}m {int(eta % 60):02d}s" if eta is not None else ""
+        ) + (
+            f"\nIn flight: {progress['in_flight']}  |  Waiting to retry: {progress['waiting_retry']}"
+            f"  |  Failures: {progress['failures']}"
+        )
+
+    def stop_progress_updates(self):
+        if getattr(self, "progress_event", None) is not None:
+            self.progress_event.cancel()
+            self.progress_event = None
+
+    def run_processing(self, resume=False):
+        try:
+            self.engine.run(self.engine.csv_path, resume=resume)
         except Exception as e:
-            self.show_popup("Error", f"Failed to read CSV: {e}")
+            self.call_on_ui(self.show_popup, "Error", f"Processing stopped: {e}")
+        finally:
+            self.call_on_ui(self.show_final_summary_screen)
 
-    def process_next_row(self):
-        if self.current_row_index >= len(self.rows_to_process):
-            self.show_final_summary_screen()
-            return
+    def begin_planning(self):
+        self.root.clear_widgets()
+        self.root.add_widget(self.processing_screen())
+        self.progress_label.text = "Planning import..."
+        worker = threading.Thread(target=self.run_planning, daemon=True)
+        worker.start()
 
-        row = self.rows_to_process[self.current_row_index]
+    def run_planning(self):
         try:
-            payload = self.build_payload(row)
+            counts = self.engine.plan(self.engine.csv_path)
         except Exception as e:
-            self.results_log.append({
-                "row_index": self.current_row_index,
-                "status": "fail",
-                "error": f"Data conversion error: {e}",
-                "action": None
-            })
-            self.current_row_index += 1
-            self.process_next_row()
+            self.call_on_ui(self.stop_progress_updates)
+            self.call_on_ui(self.show_popup, "Error", f"Planning stopped: {e}")
             return
+        self.call_on_ui(self.show_plan_screen, counts)
 
-        key_value = row.get(self.key_column, None)
-        if not key_value:
-            self.results_log.append({
-                "row_index": self.current_row_index,
-                "status": "fail",
-                "error": "No key value found in this row",
-                "action": None
-            })
-            self.current_row_index += 1
-            self.process_next_row()
-            return
+    def show_plan_screen(self, counts):
+        self.stop_progress_updates()
+        layout = BoxLayout(orientation='vertical', spacing=10, padding=10)
 
-        existing_id = self.fetch_id_by_key_value(self.key_column, key_value)
+        plan_text = (
+            f"Dry run complete, nothing was sent.\n\n"
+            f"To create: {counts.get('create', 0)}\n"
+            f"To update: {counts.get('update', 0)}\n"
+            f"Unchanged: {counts.get('unchanged', 0)}\n"
+            f"To skip: {counts.get('skip', 0)}\n"
+            f"Invalid: {counts.get('invalid', 0)}\n"
+            f"\nPlan written to {counts['plan_file']}\n"
+        )
+        layout.add_widget(Label(text=plan_text, size_hint_y=None, height=200))
 
-        if existing_id is not None:
-            #Update or Create
-            self.show_update_or_create_popup(existing_id, payload, key_value)
-        else:
-            self.create_record(payload, row_index=self.current_row_index)
-            self.current_row_index += 1
-            self.process_next_row()
-
-    def fetch_id_by_key_value(self, key_column, key_value):
-        api_field_for_key = self.field_mappings.get(key_column)
-        if not api_field_for_key:
-            return None
-
-        url = f"{self.base_url}/csi-requesthandler/api/v2/{self.endpoint}?{api_field_for_key}={key_value}"
-        headers = {
-            "accept": "application/json",
-            "Content-Type": "application/json",
-            "Cookie": self.session_token
-        }
-
-        success, result = self._request_with_retry("GET", url, headers=headers)
-        if not success:
-            print(f"Fetch ID request failed: {result}")
-            return None
-
-        resp = result
-        if resp.status_code == 200:
-            data = resp.json()
-            if isinstance(data, list) and len(data) > 0:
-                return data[0].get("id")
-            elif isinstance(data, dict):
-                return data.get("id")
-            return None
-        else:
-            return None
+        apply_button = Button(text="Apply Plan", size_hint_y=None, height=50)
+        apply_button.bind(on_press=lambda x: self.begin_applying(counts['plan_file']))
+        layout.add_widget(apply_button)
+
+        close_button = Button(text="Close / Return to Main Menu", size_hint_y=None, height=50)
+        close_button.bind(on_press=lambda x: self.reset_to_login())
+        layout.add_widget(close_button)
+
+        self.root.clear_widgets()
+        self.root.add_widget(layout)
+
+    def begin_applying(self, plan_path):
+        self.root.clear_widgets()
+        self.root.add_widget(self.processing_screen())
+        worker = threading.Thread(target=self.run_applying, args=(plan_path,), daemon=True)
+        worker.start()
+
+    def run_applying(self, plan_path):
+        try:
+            self.engine.apply_plan(plan_path)
+        except Exception as e:
+            self.call_on_ui(self.show_popup, "Error", f"Processing stopped: {e}")
+        finally:
+            self.call_on_ui(self.show_final_summary_screen)
+
+    def ask_update_or_create(self, resource_id, key_value):
+        # runs on the worker thread and waits for the user's choice
+        answered = threading.Event()
+        choice = {}
+
+        def on_choice(action):
+            choice["action"] = action
+            answered.set()
+
+        self.call_on_ui(self.show_update_or_create_popup, resource_id, key_value, on_choice)
+        answered.wait()
+        return choice["action"]
+
+    def show_update_or_create_popup(self, resource_id, key_value, on_choice):
+        from kivy.uix.popup import Popup
 
-    def show_update_or_create_popup(self, resource_id, payload, key_value):
         layout = BoxLayout(orientation='vertical', spacing=10, padding=10)
         msg = (
             f"Key '{key_value}' already exists (id={resource_id}).\n"
@@ -469,8 +643,10 @@ class MappingApp(App):
         button_box = BoxLayout(orientation='horizontal', spacing=10, size_hint_y=None, height=50)
         update_btn = Button(text="Update Existing")
         create_btn = Button(text="Create New")
+        skip_btn = Button(text="Skip")
         button_box.add_widget(update_btn)
         button_box.add_widget(create_btn)
+        button_box.add_widget(skip_btn)
         layout.add_widget(button_box)
 
         popup = Popup(
@@ -482,168 +658,44 @@ class MappingApp(App):
 
         def on_update(instance):
             popup.dismiss()
-            self.update_record(resource_id, payload, row_index=self.current_row_index)
-            self.current_row_index += 1
-            self.process_next_row()
+            on_choice("update")
 
         def on_create(instance):
             popup.dismiss()
-            self.create_record(payload, row_index=self.current_row_index)
-            self.current_row_index += 1
-            self.process_next_row()
+            on_choice("create")
+
+        def on_skip(instance):
+            popup.dismiss()
+            on_choice("skip")
 
         update_btn.bind(on_press=on_update)
         create_btn.bind(on_press=on_create)
+        skip_btn.bind(on_press=on_skip)
         popup.open()
 
-    def build_payload(self, row):
-        payload = {}
-        for csv_header, api_field in self.field_mappings.items():
-            csv_value = row.get(csv_header, "")
-            expected_type = self.api_fields.get(api_field, "string")
-
-            if expected_type in ("float", "int"):
-                if self.is_number(csv_value):
-                    converted_value = float(csv_value) if expected_type == "float" else int(csv_value)
-                else:
-                    raise ValueError(f"Invalid number for field '{api_field}': {csv_value}")
-            elif expected_type == "NoneType" and not csv_value:
-                converted_value = None
-            else:
-                converted_value = csv_value
-
-            payload[api_field] = converted_value
-
-        return payload
-
-    def is_number(self, val):
-        try:
-            float(val)
-            return True
-        except ValueError:
-            return False
-
-    
-    #C/U
-    
-    def create_record(self, payload, row_index):
-        url = f"{self.base_url}/csi-requesthandler/api/v2/{self.endpoint}"
-        headers = {
-            "accept": "application/json",
-            "Content-Type": "application/json",
-            "Cookie": self.session_token
-        }
-
-        success, result = self._request_with_retry("POST", url, headers=headers, json=payload)
-        if success:
-            resp = result
-            #200 or 201 as success
-            if resp.status_code in (200, 201):
-                self.results_log.append({
-                    "row_index": row_index,
-                    "status": "success",
-                    "error": None,
-                    "action": "create"
-                })
-            else:
-                self.results_log.append({
-                    "row_index": row_index,
-                    "status": "fail",
-                    "error": f"Create error: {resp.status_code} - {resp.text}",
-                    "action": "create"
-                })
-        else:
-            self.results_log.append({
-                "row_index": row_index,
-                "status": "fail",
-                "error": f"Create request exception: {result}",
-                "action": "create"
-            })
-
-    def update_record(self, resource_id, payload, row_index):
-        url = f"{self.base_url}/csi-requesthandler/api/v2/{self.endpoint}/{resource_id}"
-        headers = {
-            "accept": "application/json",
-            "Content-Type": "application/json",
-            "Cookie": self.session_token
-        }
-
-        success, result = self._request_with_retry("PUT", url, headers=headers, json=payload)
-        if success:
-            resp = result
-            if resp.status_code in (200, 201):
-                self.results_log.append({
-                    "row_index": row_index,
-                    "status": "success",
-                    "error": None,
-                    "action": "update"
-                })
-            else:
-                self.results_log.append({
-                    "row_index": row_index,
-                    "status": "fail",
-                    "error": f"Update error: {resp.status_code} - {resp.text}",
-                    "action": "update"
-                })
-        else:
-            self.results_log.append({
-                "row_index": row_index,
-                "status": "fail",
-                "error": f"Update request exception: {result}",
-                "action": "update"
-            })
-
-    def _request_with_retry(self, method, url, headers=None, json=None, max_retries=3, backoff_factor=1):
-        
-        attempt = 0
-        while attempt < max_retries:
-            try:
-                if method.upper() == "POST":
-                    resp = requests.post(url, headers=headers, json=json)
-                elif method.upper() == "PUT":
-                    resp = requests.put(url, headers=headers, json=json)
-                elif method.upper() == "GET":
-                    resp = requests.get(url, headers=headers)
-                else:
-                    raise ValueError(f"Unsupported HTTP method: {method}")
-
-                # Retry on 5xx
-                if 500 <= resp.status_code < 600:
-                    if attempt < max_retries - 1:
-                        sleep_time = backoff_factor * (2 ** attempt)
-                        time.sleep(sleep_time)
-                    attempt += 1
-                else:
-                    return (True, resp)
-
-            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
-                if attempt < max_retries - 1:
-                    sleep_time = backoff_factor * (2 ** attempt)
-                    time.sleep(sleep_time)
-                attempt += 1
-                if attempt >= max_retries:
-                    return (False, e)
-            except Exception as e:
-                return (False, e)
-
-        return (False, f"Request failed after {max_retries} attempts.")
-
-    
     #LASTMINUTE
     
     def show_final_summary_screen(self):
+        self.stop_progress_updates()
         layout = BoxLayout(orientation='vertical', spacing=10, padding=10)
 
-        total_rows = len(self.results_log)
-        success_count = sum(1 for r in self.results_log if r["status"] == "success")
-        fail_count = total_rows - success_count
+        summary = self.engine.summary()
 
         summary_text = (
             f"Processing complete!\n\n"
-            f"Total rows processed: {total_rows}\n"
-            f"Successes: {success_count}\n"
-            f"Failures: {fail_count}\n"
+            f"Total rows processed: {summary['total']}\n"
+            f"Successes: {summary['success']}\n"
+            f"Skipped: {summary['skipped']}\n"
+            f"Unchanged (not sent): {summary['unchanged']}\n"
+            f"Already done in a previous run: {summary['resumed']}\n"
+            f"Failures: {summary['fail']}\n"
         )
+        if self.engine.results is not None:
+            summary_text += f"\nResults written to {self.engine.results.path}\n"
+        report = self.engine.preflight_report
+        if report is not None and not report.ok():
+            summary_text += (f"Pre-flight: {report.bad_cells} bad cells, {report.missing_keys} rows "
+                             f"without a key (see {report.report_path})\n")
 
         summary_label = Label(text=summary_text, size_hint_y=None, height=200)
         layout.add_widget(summary_label)
@@ -652,10 +704,18 @@ class MappingApp(App):
         export_button.bind(on_press=self.on_export_csv_pressed)
         layout.add_widget(export_button)
 
+        metrics_button = Button(text="Show Metrics", size_hint_y=None, height=50)
+        metrics_button.bind(on_press=lambda x: self.show_metrics_popup())
+        layout.add_widget(metrics_button)
+
         save_config_button = Button(text="Save Config", size_hint_y=None, height=50)
         save_config_button.bind(on_press=self.on_save_config_pressed)
         layout.add_widget(save_config_button)
 
+        save_profile_button = Button(text="Save as Job Profile", size_hint_y=None, height=50)
+        save_profile_button.bind(on_press=lambda x: self.show_save_profile_popup())
+        layout.add_widget(save_profile_button)
+
         close_button = Button(text="Close / Return to Main Menu", size_hint_y=None, height=50)
         close_button.bind(on_press=lambda x: self.reset_to_login())
         layout.add_widget(close_button)
@@ -670,56 +730,113 @@ class MappingApp(App):
 
     def on_save_config_pressed(self, instance):
        
-        self.config_data["base_url"] = self.base_url
-        self.config_data["endpoint"] = self.endpoint
-        self.config_data["key_column"] = self.key_column
-        self.config_data["field_mappings"] = self.field_mappings
+        self.engine.store_config()
 
         self.save_config(self.config_data)
         self.show_popup("Save Config", "Configuration saved to file!")
 
+    def show_save_profile_popup(self):
+        from kivy.uix.popup import Popup
+
+        layout = BoxLayout(orientation='vertical', spacing=10, padding=10)
+        name_input = TextInput(hint_text="Profile name", multiline=False, size_hint_y=None, height=50)
+        layout.add_widget(name_input)
+        save_button = Button(text="Save", size_hint_y=None, height=50)
+        layout.add_widget(save_button)
+        popup = Popup(title="Save as Job Profile", content=layout, size_hint=(0.6, 0.4))
+
+        def on_save(instance):
+            name = name_input.text.strip()
+            if not name:
+                return
+            popup.dismiss()
+            self.config_data.setdefault("profiles", {})[name] = self.engine.job_profile()
+            self.save_config(self.config_data)
+            self.show_popup("Job Profile", f"Saved job profile '{name}'.")
+
+        save_button.bind(on_press=on_save)
+        popup.open()
+
+    #JOBS
+
+    def show_jobs_screen(self):
+        if self.engine.credentials is None:
+            self.show_popup("Error", "Please log in again to run jobs.")
+            return
+        names = list(self.config_data.get("profiles", {}))
+        try:
+            self.scheduler = inv_core.JobScheduler(self.config_data, names, self.config_filename)
+        except ValueError as e:
+            self.show_popup("Error", str(e))
+            return
+
+        layout = BoxLayout(orientation='vertical', spacing=10, padding=10)
+        layout.add_widget(Label(text=f"Running {len(names)} jobs", font_size=24, size_hint_y=None, height=50))
+        self.job_labels = {}
+        self.job_meters = {}
+        for job in self.scheduler.jobs:
+            label = Label(text=f"{job.name}: queued", font_size=18)
+            self.job_labels[job.name] = label
+            self.job_meters[job.name] = inv_core.ProgressMeter()
+            layout.add_widget(label)
+
+        self.jobs_done_button = Button(text="Back", size_hint_y=None, height=50, disabled=True)
+        self.jobs_done_button.bind(on_press=lambda x: self.leave_jobs_screen())
+        layout.add_widget(self.jobs_done_button)
+
+        self.root.clear_widgets()
+        self.root.add_widget(layout)
+        self.scheduler.start(*self.engine.credentials)
+        self.jobs_event = Clock.schedule_interval(
+            self.refresh_jobs, self.config_data.get("progress_refresh_seconds", 0.5)
+        )
+
+    def refresh_jobs(self, dt):
+        for name, progress in self.scheduler.progress().items():
+            progress = self.job_meters[name].sample(progress)
+            text = f"{name}: {progress['status']}, {progress['rows_done']} rows"
+            if progress["status"] == "running" and progress["rows_per_second"] is not None:
+                text += f", {progress['rows_per_second']:.1f} rows/sec"
+            text += f", {progress['failures']} failed"
+            self.job_labels[name].text = text
+        if not self.scheduler.running():
+            self.jobs_event.cancel()
+            for job in self.scheduler.jobs:
+                detail = job.error or (job.engine.results.path if job.engine.results is not None else "")
+                self.job_labels[job.name].text += f"\n{detail}"
+            self.jobs_done_button.disabled = False
+
+    def leave_jobs_screen(self):
+        self.scheduler.wait()
+        self.scheduler = None
+        self.root.clear_widgets()
+        self.root.add_widget(self.upload_screen())
+
     def export_results_to_csv(self, filename):
-        import csv
-        fieldnames = ["row_index", "status", "error", "action"]
         try:
-            with open(filename, "w", newline="", encoding="utf-8") as f:
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                for entry in self.results_log:
-                    writer.writerow(entry)
-            print(f"Exported results log to {filename}")
+            self.engine.export_results_to_csv(filename)
         except Exception as e:
             self.show_popup("Error", f"Could not write CSV: {e}")
 
     def reset_to_login(self):
+        self.engine.close_http_session()
         self.root.clear_widgets()
         self.root.add_widget(self.login_screen())
 
+    def call_on_ui(self, fn, *args):
+        Clock.schedule_once(lambda dt: fn(*args))
+
     def show_popup(self, title, message):
+        from kivy.uix.popup import Popup
+
         popup = Popup(title=title, content=Label(text=message), size_hint=(0.6, 0.4))
         popup.open()
 
     def load_config(self):
-        
-        if os.path.exists(self.config_filename):
-            try:
-                with open(self.config_filename, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                print("Loaded config from file:", data)
-                return data
-            except Exception as e:
-                print("Error reading config file:", e)
-                return {}
-        return {}
+        return inv_core.load_config(self.config_filename)
 
     def save_config(self, data):
-       
-        try:
-            with open(self.config_filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2)
-            print("Saved config to file:", data)
-        except Exception as e:
-            print("Error saving config file:", e)
+        inv_core.save_config(data, self.config_filename)
 
 
 if __name__ == "__main__":
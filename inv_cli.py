@@ -0,0 +1,267 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+import requests
+
+import inv_core
+from inv_core import UpsertEngine
+
+# Headless CSV -> endpoint upsert for cron/CI. Reads the same
+# mapping_config.json as the Kivy app, never imports Kivy, prints a JSON
+# summary on stdout (engine chatter goes to stderr) and exits with:
+EXIT_OK = 0             # every row succeeded
+EXIT_ROW_FAILURES = 1   # the run finished but some rows failed
+EXIT_USAGE = 2          # bad arguments or incomplete config
+EXIT_CONNECTION = 3     # login, endpoint or CSV could not be reached
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Upsert a CSV file into a CSI request-handler endpoint.")
+    parser.add_argument("csv_file", nargs="?",
+                        help="CSV file to import (not used with --job/--all-jobs/--apply)")
+    parser.add_argument("--config", default=inv_core.CONFIG_FILENAME,
+                        help="config file written by the app (default: %(default)s)")
+    parser.add_argument("--url", help="environment base URL, e.g. https://plm.example.com")
+    parser.add_argument("--username")
+    parser.add_argument("--password",
+                        help="password (prefer the INV_PASSWORD environment variable)")
+    parser.add_argument("--endpoint", help="REST endpoint, e.g. styles")
+    parser.add_argument("--key-column", help="CSV column used to find existing records")
+    parser.add_argument("--map", action="append", default=[], metavar="CSV_HEADER=API_FIELD",
+                        help="field mapping; repeat for each column (replaces the saved mappings)")
+    parser.add_argument("--on-existing", choices=inv_core.DUPLICATE_POLICIES,
+                        help="what to do when a key already exists; 'ask' updates when headless")
+    parser.add_argument("--workers", type=int, help="concurrent create/update requests")
+    parser.add_argument("--batch-size", type=int,
+                        help="rows per create/update request, sent as a JSON array (0 = one per request)")
+    parser.add_argument("--skip-unchanged", action="store_true",
+                        help="don't send updates whose mapped fields already match the server")
+    parser.add_argument("--refresh-schema", action="store_true",
+                        help="fetch the endpoint's fields even if a cached copy is still fresh")
+    parser.add_argument("--preflight", action="store_true",
+                        help="parse and convert the whole CSV on all cores before sending anything")
+    parser.add_argument("--preflight-only", action="store_true",
+                        help="only run the pre-flight and report bad cells and missing keys")
+    parser.add_argument("--plan", nargs="?", const="", metavar="PLAN_FILE",
+                        help="dry run: resolve every row and write a plan instead of sending anything "
+                             "(default file: CSV_FILE.plan.jsonl)")
+    parser.add_argument("--apply", metavar="PLAN_FILE",
+                        help="send the rows of a plan written by --plan; no lookups are made")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip rows recorded in the journal of an earlier, interrupted run")
+    parser.add_argument("--results", default="results_log.csv",
+                        help="where to write the per-row results log (default: %(default)s)")
+    parser.add_argument("--metrics", metavar="PREFIX",
+                        help="write metrics to PREFIX.json and PREFIX.prom (default: next to the CSV)")
+    parser.add_argument("--job", action="append", default=[], metavar="PROFILE",
+                        help="run a saved job profile instead of csv_file; repeat to run several at once")
+    parser.add_argument("--all-jobs", action="store_true", help="run every saved job profile at once")
+    parser.add_argument("--max-requests", type=int,
+                        help="concurrent requests shared by all jobs (default: max_concurrent_requests or 16)")
+    parser.add_argument("--progress-every", type=float, default=10.0, metavar="SECONDS",
+                        help="how often job progress goes to stderr (default: %(default)s)")
+    parser.add_argument("--summary-json", default="-",
+                        help="file for the JSON summary, '-' for stdout (default)")
+    return parser.parse_args(argv)
+
+
+def apply_overrides(config_data, args):
+    if args.url:
+        config_data["base_url"] = args.url.rstrip("/")
+    if args.username:
+        config_data["username"] = args.username
+    if args.endpoint:
+        config_data["endpoint"] = args.endpoint
+    if args.key_column:
+        config_data["key_column"] = args.key_column
+    if args.on_existing:
+        config_data["duplicate_policy"] = args.on_existing
+    if args.workers:
+        config_data["max_workers"] = args.workers
+    if args.preflight or args.preflight_only:
+        config_data["preflight"] = True
+    if args.skip_unchanged:
+        config_data["skip_unchanged"] = True
+    if args.batch_size is not None:
+        config_data["batch_size"] = args.batch_size
+    if args.map:
+        mappings = {}
+        for item in args.map:
+            csv_header, sep, api_field = item.partition("=")
+            if not sep or not csv_header or not api_field:
+                raise ValueError(f"Invalid --map '{item}', expected CSV_HEADER=API_FIELD")
+            mappings[csv_header] = api_field
+        config_data["field_mappings"] = mappings
+    return config_data
+
+
+def write_summary(summary, destination):
+    text = json.dumps(summary, indent=2)
+    if destination == "-":
+        print(text)
+    else:
+        with open(destination, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+def run_jobs(args):
+    summary = {}
+    # each profile brings its own endpoint, key column, mapping and policy,
+    # which would quietly replace these
+    per_job = [flag for flag, value in (
+        ("--endpoint", args.endpoint),
+        ("--key-column", args.key_column),
+        ("--map", args.map),
+        ("--on-existing", args.on_existing),
+    ) if value]
+    if per_job:
+        summary["error"] = f"{', '.join(per_job)} cannot be used with --job / --all-jobs (set them in the job profile)"
+        return EXIT_USAGE, summary
+    try:
+        config_data = apply_overrides(inv_core.load_config(args.config), args)
+        names = list(config_data.get("profiles", {})) if args.all_jobs else args.job
+        if not names:
+            raise ValueError(f"No job profiles saved in {args.config}")
+        if args.max_requests:
+            config_data["max_concurrent_requests"] = args.max_requests
+        scheduler = inv_core.JobScheduler(config_data, names, args.config)
+    except ValueError as e:
+        summary["error"] = str(e)
+        return EXIT_USAGE, summary
+    if not config_data.get("base_url") or not config_data.get("username"):
+        summary["error"] = f"Missing url or username (set them in {args.config} or on the command line)"
+        return EXIT_USAGE, summary
+
+    password = args.password or os.environ.get("INV_PASSWORD", "")
+    started = time.monotonic()
+    scheduler.start(config_data["username"], password)
+    meters = {job.name: inv_core.ProgressMeter() for job in scheduler.jobs}
+    next_report = time.monotonic() + args.progress_every
+    while scheduler.running():
+        time.sleep(0.2)
+        if time.monotonic() < next_report:
+            continue
+        next_report += args.progress_every
+        for name, progress in scheduler.progress().items():
+            progress = meters[name].sample(progress)
+            rate = progress["rows_per_second"]
+            speed = f", {rate:.1f} rows/sec" if progress["status"] == "running" and rate is not None else ""
+            print(f"[{name}] {progress['status']}: {progress['rows_done']} rows{speed}, "
+                  f"{progress['failures']} failed")
+    scheduler.wait()
+
+    summary["elapsed_seconds"] = round(time.monotonic() - started, 3)
+    summary["jobs"] = scheduler.summary()
+    if any(job["status"] == "failed" for job in summary["jobs"]):
+        return EXIT_CONNECTION, summary
+    if any(job.get("fail") for job in summary["jobs"]):
+        return EXIT_ROW_FAILURES, summary
+    return EXIT_OK, summary
+
+
+def run(args):
+    if args.job or args.all_jobs:
+        return run_jobs(args)
+    summary = {"csv_file": args.csv_file}
+    try:
+        config_data = apply_overrides(inv_core.load_config(args.config), args)
+        if args.apply:
+            summary["csv_file"] = args.csv_file = inv_core.read_plan_header(args.apply)["csv_file"]
+    except (ValueError, OSError) as e:
+        summary["error"] = str(e)
+        return EXIT_USAGE, summary
+    if not args.csv_file:
+        summary["error"] = "No CSV file given (or use --job / --all-jobs / --apply)"
+        return EXIT_USAGE, summary
+
+    engine = UpsertEngine(config_data, args.config)
+    summary["endpoint"] = engine.endpoint
+    password = args.password or os.environ.get("INV_PASSWORD", "")
+    missing = [name for name, value in (
+        ("url", engine.base_url),
+        ("username", config_data.get("username")),
+        ("endpoint", engine.endpoint),
+        ("key column", engine.key_column),
+        ("field mappings", engine.field_mappings),
+    ) if not value]
+    if missing:
+        summary["error"] = f"Missing {', '.join(missing)} (set them in {args.config} or on the command line)"
+        return EXIT_USAGE, summary
+
+    try:
+        if args.apply:
+            engine.login(config_data["username"], password)
+            engine.results_path = args.results
+            engine.metrics_prefix = args.metrics
+            started = time.monotonic()
+            engine.apply_plan(args.apply, resume=args.resume)
+            return finish_run(engine, summary, args, time.monotonic() - started)
+
+        headers = engine.read_csv_headers(args.csv_file)
+        unknown = [h for h in [engine.key_column, *engine.field_mappings] if h not in headers]
+        if unknown:
+            summary["error"] = f"Columns not in CSV: {', '.join(unknown)}"
+            return EXIT_USAGE, summary
+
+        engine.login(config_data["username"], password)
+        engine.fetch_api_fields(refresh=args.refresh_schema)
+
+        if engine.duplicate_check == "prescan":
+            scan = engine.scan_keys(args.csv_file, engine.key_column)
+            if scan.duplicates:
+                summary["error"] = f"{len(scan.duplicates)} duplicate values found in column '{engine.key_column}'"
+                summary["duplicates"] = scan.duplicates
+                return EXIT_USAGE, summary
+            engine.key_scan = scan
+
+        if args.preflight_only:
+            report = engine.preflight(args.csv_file)
+            summary["preflight"] = report.to_json()
+            return (EXIT_OK if report.ok() else EXIT_ROW_FAILURES), summary
+
+        if args.plan is not None:
+            counts = engine.plan(args.csv_file, args.plan or None)
+            summary["plan_file"] = counts.pop("plan_file")
+            summary["plan"] = counts
+            return (EXIT_ROW_FAILURES if counts.get("invalid") else EXIT_OK), summary
+
+        # results stream straight into the requested file
+        engine.results_path = args.results
+        engine.metrics_prefix = args.metrics
+        started = time.monotonic()
+        engine.run(args.csv_file, resume=args.resume)
+        return finish_run(engine, summary, args, time.monotonic() - started)
+    except (ValueError, OSError, requests.exceptions.RequestException) as e:
+        summary["error"] = str(e)
+        return EXIT_CONNECTION, summary
+    finally:
+        engine.close_http_session()
+
+
+def finish_run(engine, summary, args, elapsed):
+    summary.update(engine.summary())
+    summary["elapsed_seconds"] = round(elapsed, 3)
+    summary["rows_per_second"] = round(summary["total"] / elapsed, 1) if elapsed else None
+    summary["results_file"] = args.results
+    summary["metrics"] = engine.metrics.to_json()["phases"]
+    if engine.preflight_report is not None:
+        summary["preflight"] = engine.preflight_report.to_json()
+    return (EXIT_ROW_FAILURES if summary["fail"] else EXIT_OK), summary
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # keep stdout clean for the JSON summary
+    with contextlib.redirect_stdout(sys.stderr):
+        exit_code, summary = run(args)
+    summary["exit_code"] = exit_code
+    write_summary(summary, args.summary_json)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2442 @@
+import codecs
+import csv
+import difflib
+import hashlib
+import hmac
+import io
+import re
+import json
+import mmap
+import os
+import time
+import random
+import heapq
+import itertools
+import bisect
+import shutil
+import threading
+from array import array
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+# Upsert engine shared by the Kivy app (inv_app.py) and the headless batch
+# entry point (inv_cli.py). Nothing in here may import Kivy, and requests is
+# only imported once a session is opened, so importing this module is cheap.
+
+CONFIG_FILENAME = "mapping_config.json"
+
+# what to do with a row whose key already exists on the server
+DUPLICATE_POLICIES = ("ask", "update", "create", "skip")
+
+
+# Converters turn one CSV cell into the API's type and raise ValueError or
+# TypeError on bad input. They are module-level so compiled mappings can be
+# pickled.
+
+def convert_string(value):
+    return value
+
+
+def convert_optional(value):
+    return value if value else None
+
+
+CONVERTERS = {
+    "float": float,
+    "int": int,
+    "NoneType": convert_optional,
+}
+
+
+def compile_mapping(field_mappings, api_fields):
+    # resolve each mapped column's converter once instead of on every row
+    return tuple(
+        (csv_header, api_field, CONVERTERS.get(api_fields.get(api_field, "string"), convert_string))
+        for csv_header, api_field in field_mappings.items()
+    )
+
+
+def merge_field_types(records):
+    # one sample record can hold None (or an int where the field is really a
+    # float), so types are merged over every sampled record: None is ignored
+    # unless it is all we saw, int+float widens to float, anything else mixed
+    # falls back to a string
+    seen = {}
+    for record in records:
+        if not isinstance(record, dict):
+            continue
+        for field, value in record.items():
+            names = seen.setdefault(field, set())
+            if value is not None:
+                names.add(type(value).__name__)
+    fields = {}
+    for field, names in seen.items():
+        if not names:
+            fields[field] = "NoneType"
+        elif len(names) == 1:
+            fields[field] = names.pop()
+        elif names <= {"int", "float"}:
+            fields[field] = "float"
+        else:
+            fields[field] = "str"
+    return fields
+
+
+def fingerprint(values):
+    # compares a payload with an existing record without keeping the record:
+    # a digest of the values' canonical JSON, compared with ==. Whole floats
+    # count as ints so 1 and 1.0 match, which is what the API round-trip needs.
+    values = [int(v) if isinstance(v, float) and v.is_integer() else v for v in values]
+    text = json.dumps(values, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def normalize_field_name(name):
+    # "Unit Price", "unit_price" and "UnitPrice" all become "unitprice"
+    return re.sub(r'[^0-9a-z]', '', name.lower())
+
+
+def suggest_mappings(csv_headers, api_fields, saved=None, cutoff=0.8):
+    # Prefill for the mapping screen: saved mappings first, then exact
+    # matches after normalizing, then the closest difflib match. Each API
+    # field is suggested for at most one header.
+    saved = saved or {}
+    by_normalized = {}
+    for api_field in api_fields:
+        by_normalized.setdefault(normalize_field_name(api_field), api_field)
+    suggestions = {h: saved[h] for h in csv_headers if saved.get(h) in api_fields}
+    taken = set(suggestions.values())
+
+    unmatched = []
+    for csv_header in csv_headers:
+        if csv_header in suggestions:
+            continue
+        api_field = by_normalized.get(normalize_field_name(csv_header))
+        if api_field is not None and api_field not in taken:
+            suggestions[csv_header] = api_field
+            taken.add(api_field)
+        else:
+            unmatched.append(csv_header)
+
+    for csv_header in unmatched:
+        free = [n for n, f in by_normalized.items() if f not in taken]
+        close = difflib.get_close_matches(normalize_field_name(csv_header), free, n=1, cutoff=cutoff)
+        if close:
+            suggestions[csv_header] = by_normalized[close[0]]
+            taken.add(by_normalized[close[0]])
+    return suggestions
+
+
+def convert_columns(compiled_mapping, rows):
+    # converts a chunk one column at a time; only a column that contains
+    # a bad value is retried cell by cell to find every bad cell in it
+    payloads = [{} for _ in rows]
+    bad_cells = []
+    for csv_header, api_field, convert in compiled_mapping:
+        values = [row.get(csv_header, "") for row in rows]
+        try:
+            converted = list(map(convert, values))
+        except (TypeError, ValueError):
+            converted = []
+            for offset, value in enumerate(values):
+                try:
+                    converted.append(convert(value))
+                except (TypeError, ValueError):
+                    converted.append(None)
+                    bad_cells.append((offset, csv_header, api_field, value))
+        for payload, value in zip(payloads, converted):
+            payload[api_field] = value
+    return payloads, bad_cells
+
+
+def bad_cell_message(api_field, value):
+    return f"Invalid number for field '{api_field}': {value}"
+
+
+def load_config(filename=CONFIG_FILENAME):
+    if os.path.exists(filename):
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            print(f"Loaded config from {filename}")
+            return data
+        except Exception as e:
+            print("Error reading config file:", e)
+            return {}
+    return {}
+
+
+def save_config(data, filename=CONFIG_FILENAME):
+    try:
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        print(f"Saved config to {filename}")
+    except Exception as e:
+        print("Error saving config file:", e)
+
+
+# concurrent jobs share one config file
+_config_file_lock = threading.Lock()
+
+
+def save_schema_cache(cache, filename=CONFIG_FILENAME):
+    # write back only the schema cache, leaving whatever else is in the file
+    # (and any unsaved or command-line settings) alone
+    with _config_file_lock:
+        data = load_config(filename)
+        data["schema_cache"] = dict(cache)
+        save_config(data, filename)
+
+
+# Job profiles: named per-file settings under "profiles" in the config.
+# Anything not in the profile (URL, username, retry and rate settings...)
+# comes from the top level of the config.
+PROFILE_KEYS = ("csv_file", "endpoint", "key_column", "field_mappings", "duplicate_policy")
+
+
+def profile_config(config_data, name):
+    profiles = config_data.get("profiles", {})
+    if name not in profiles:
+        raise ValueError(f"No job profile named '{name}'")
+    merged = {k: v for k, v in config_data.items() if k != "profiles"}
+    merged.update(profiles[name])
+    return merged
+
+
+class TokenBucket:
+    # Client-side rate limit: on average `rate` requests per second, with
+    # bursts of up to `burst`. acquire() waits until a token is free.
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# one bucket per base URL, shared by every engine talking to that server
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def rate_limiter_for(base_url, rate, burst=None):
+    if not rate:
+        return None
+    with _rate_limiters_lock:
+        bucket = _rate_limiters.get(base_url)
+        if bucket is None or bucket.rate != rate:
+            bucket = TokenBucket(rate, burst)
+            _rate_limiters[base_url] = bucket
+        return bucket
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+# Response bodies are parsed as they arrive, so reading the first match of a
+# lookup, or a sample of a collection, doesn't mean downloading and holding
+# the whole thing.
+JSON_CHUNK_BYTES = 64 * 1024
+
+
+def iter_json_items(chunks, whole=True):
+    # Yields the elements of a top-level JSON array one at a time from an
+    # iterable of byte chunks, reading only as far as the caller gets. Any
+    # other top-level value is yielded whole, or skipped when whole is false.
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8-sig")()
+    chunks = iter(chunks)
+    buf, pos, eof = "", 0, False
+
+    def fill():
+        # drop what has been parsed and append the next chunk
+        nonlocal buf, pos, eof
+        for chunk in chunks:
+            if chunk:
+                buf = buf[pos:] + text.decode(chunk)
+                pos = 0
+                return
+        buf = buf[pos:] + text.decode(b"", final=True)
+        pos = 0
+        eof = True
+
+    def peek():
+        # next non-whitespace character, or None at the end of the body
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if eof:
+                return None
+            fill()
+
+    def decode():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                fill()
+                continue
+            if not eof and (end == len(buf) or buf[end] in ".eE+-0123456789"):
+                # a number cut off at the end of a chunk ("1" of "1.5")
+                fill()
+                continue
+            pos = end
+            return value
+
+    first = peek()
+    if first != "[":
+        while not eof:
+            fill()
+        value = json.loads(buf[pos:])
+        if whole:
+            yield value
+        return
+    pos += 1
+    if peek() == "]":
+        return
+    while True:
+        yield decode()
+        separator = peek()
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError(f"Expecting ',' or ']' in JSON array, got {separator!r}")
+        pos += 1
+
+
+def unread_bytes(resp):
+    # body bytes still on the wire for a streamed response, if known
+    try:
+        return int(resp.headers["Content-Length"]) - resp.raw.tell()
+    except (KeyError, ValueError, AttributeError, TypeError):
+        return None
+
+
+def iter_response_items(resp, whole=True):
+    # iter_json_items over a response sent with stream=True. Stopping early
+    # closes the connection unless only a little is left, which is drained
+    # so the connection goes back to the pool.
+    chunks = resp.iter_content(JSON_CHUNK_BYTES)
+    try:
+        yield from iter_json_items(chunks, whole)
+    finally:
+        left = unread_bytes(resp)
+        if left is not None and left <= JSON_CHUNK_BYTES:
+            for _ in chunks:
+                pass
+        resp.close()
+
+
+def first_json_item(resp, whole=True):
+    items = iter_response_items(resp, whole)
+    try:
+        return next(items, None)
+    finally:
+        items.close()
+
+
+class Retry:
+    # Returned by an executor task that wants fn(*args) run again after
+    # `delay` seconds. The worker thread is freed while it waits.
+
+    def __init__(self, delay, fn, *args):
+        self.delay = delay
+        self.fn = fn
+        self.args = args
+
+
+def batch_rows(items):
+    # row indexes of a batch of (row_index, existing_id, payload) items
+    return [row_index for row_index, _, _ in items]
+
+
+class KeyedExecutor:
+    # Runs tasks on a thread pool, but never two tasks with the same key at
+    # the same time: a task whose key is busy waits in a per-key queue.
+    # submit() blocks once max_pending tasks are queued so callers can't
+    # run arbitrarily far ahead of the network. A task that returns a Retry
+    # is parked on a timer heap, keeping its key busy, and resubmitted when
+    # due instead of sleeping on a worker. Up to max_parked parked tasks
+    # hand their submit slot back, so rows waiting out a long Retry-After
+    # don't hold up the rows behind them.
+
+    def __init__(self, max_workers, max_pending=None, max_parked=1000):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_pending or max_workers * 4)
+        self.parked_slots = threading.BoundedSemaphore(max_parked) if max_parked else None
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.waiting = {}
+        self.pending = 0
+        self.running = 0
+        self.delayed = []
+        self.delayed_ready = threading.Condition(self.lock)
+        self.sequence = itertools.count()
+        self.stopped = False
+        self.timer_thread = threading.Thread(target=self._run_timers, daemon=True)
+        self.timer_thread.start()
+
+    def submit(self, key, fn, *args):
+        self.slots.acquire()
+        with self.lock:
+            self.pending += 1
+            if key in self.waiting:
+                self.waiting[key].append((fn, args))
+                return
+            self.waiting[key] = deque()
+        self.pool.submit(self._run, key, fn, args)
+
+    def _run(self, key, fn, args, parked=False):
+        # parked: the task holds a parked slot instead of a submit slot
+        result = None
+        with self.lock:
+            self.running += 1
+        try:
+            result = fn(*args)
+        except Exception as e:
+            print(f"Task for key '{key}' failed: {e}")
+        finally:
+            with self.lock:
+                self.running -= 1
+        if isinstance(result, Retry):
+            if not parked and self.parked_slots is not None and self.parked_slots.acquire(blocking=False):
+                self.slots.release()
+                parked = True
+            with self.lock:
+                due = time.monotonic() + result.delay
+                heapq.heappush(self.delayed, (due, next(self.sequence), key, result.fn, result.args, parked))
+                self.delayed_ready.notify()
+            return
+
+        if parked:
+            self.parked_slots.release()
+        else:
+            self.slots.release()
+        with self.lock:
+            self.pending -= 1
+            queued = self.waiting[key]
+            if queued:
+                next_task = queued.popleft()
+            else:
+                del self.waiting[key]
+                next_task = None
+            if not self.pending:
+                self.idle.notify_all()
+        if next_task:
+            self.pool.submit(self._run, key, *next_task)
+
+    def _run_timers(self):
+        with self.lock:
+            while not self.stopped:
+                if not self.delayed:
+                    self.delayed_ready.wait()
+                    continue
+                wait = self.delayed[0][0] - time.monotonic()
+                if wait > 0:
+                    self.delayed_ready.wait(wait)
+                    continue
+                _, _, key, fn, args, parked = heapq.heappop(self.delayed)
+                self.pool.submit(self._run, key, fn, args, parked)
+
+    def wait(self):
+        with self.lock:
+            while self.pending:
+                self.idle.wait()
+
+    def shutdown(self):
+        self.wait()
+        with self.lock:
+            self.stopped = True
+            self.delayed_ready.notify()
+        self.pool.shutdown()
+
+
+class RunJournal:
+    # Append-only record of finished rows ("row_index<TAB>action<TAB>id") so a
+    # run that dies part way can resume without re-sending them. Entries are
+    # buffered and flushed every flush_every rows, so at most that many rows
+    # are sent again after a crash. The header names the endpoint and the
+    # signature (path, size, mtime) of the file the rows were read from; row
+    # indexes mean nothing for an edited or replaced file.
+
+    def __init__(self, path, endpoint, source, flush_every=50, resume=False):
+        self.path = path
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.done_rows = self.load(path, endpoint, source) if resume else {}
+        if self.done_rows:
+            self.file = open(path, 'a', encoding='utf-8')
+        else:
+            self.file = open(path, 'w', encoding='utf-8')
+            self.file.write(f"#endpoint\t{endpoint}\n#source\t{json.dumps(list(source))}\n")
+            self.file.flush()
+
+    @staticmethod
+    def load(path, endpoint, source):
+        # row_index -> action of every finished row
+        done_rows = {}
+        actions = {}
+        if not os.path.exists(path):
+            return done_rows
+        with open(path, 'r', encoding='utf-8') as f:
+            if f.readline().rstrip("\n") != f"#endpoint\t{endpoint}":
+                print(f"Journal {path} belongs to another endpoint, starting over.")
+                return done_rows
+            if f.readline().rstrip("\n") != f"#source\t{json.dumps(list(source))}":
+                print(f"Journal {path} was written for another version of the file, starting over.")
+                return done_rows
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                # a torn last line from a crash is simply ignored
+                if len(fields) == 3 and fields[0].isdigit():
+                    done_rows[int(fields[0])] = actions.setdefault(fields[1], fields[1])
+        return done_rows
+
+    def record(self, row_index, action, record_id):
+        with self.lock:
+            self.buffer.append(f"{row_index}\t{action}\t{'' if record_id is None else record_id}\n")
+            if len(self.buffer) >= self.flush_every:
+                self._flush()
+
+    def _flush(self):
+        self.file.write("".join(self.buffer))
+        self.file.flush()
+        self.buffer.clear()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.file.close()
+
+    def discard(self):
+        self.close()
+        os.remove(self.path)
+
+
+# Pre-flight: the CSV is cut into byte ranges that each start and end on a
+# record boundary, and the ranges are parsed and converted in a process
+# pool before any row is sent. Each worker writes one payload-stream line
+# per row, so after the parts are joined line N of the stream is row N.
+
+def csv_chunk_ranges(path, chunk_bytes, block_size=1 << 20):
+    # A newline ends a record only outside quotes, i.e. after an even
+    # number of quote characters ("" escapes keep the count even). The
+    # first record end is the end of the header line.
+    cuts = []
+    want = 0
+    quotes = 0
+    pos = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            counted = 0
+            while True:
+                search_from = max(counted, want - pos)
+                if search_from >= len(block):
+                    break
+                quotes += block.count(b'"', counted, search_from)
+                newline = block.find(b'\n', search_from)
+                if newline == -1:
+                    counted = search_from
+                    break
+                quotes += block.count(b'"', search_from, newline)
+                counted = newline
+                if quotes % 2 == 0:
+                    cuts.append(pos + newline + 1)
+                    want = pos + newline + 1 + chunk_bytes
+                else:
+                    want = pos + newline + 1
+            quotes += block.count(b'"', counted)
+            pos += len(block)
+    if not cuts:
+        return []
+    if cuts[-1] < pos:
+        cuts.append(pos)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def preflight_chunk(task):
+    # runs in a worker process: parse one byte range, convert every row and
+    # write its payload-stream lines; problems go back to the parent
+    path, start, end, fieldnames, key_column, compiled_mapping, out_path = task
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    rows = list(csv.DictReader(io.StringIO(data.decode('utf-8'), newline=''), fieldnames=fieldnames))
+    payloads, bad_cells = convert_columns(compiled_mapping, rows)
+    errors = {}
+    for offset, _, api_field, value in bad_cells:
+        errors.setdefault(offset, []).append(bad_cell_message(api_field, value))
+    missing_keys = []
+    with open(out_path, 'w', encoding='utf-8') as out:
+        for offset, (row, payload) in enumerate(zip(rows, payloads)):
+            key_value = row.get(key_column) or ""
+            if not key_value:
+                missing_keys.append(offset)
+            if offset in errors:
+                line = [key_value, None, "; ".join(errors[offset])]
+            else:
+                line = [key_value, payload, None]
+            out.write(json.dumps(line) + "\n")
+    return len(rows), bad_cells, missing_keys
+
+
+def read_plan_header(plan_path):
+    # first line of a plan written by UpsertEngine.plan()
+    with open(plan_path, 'r', encoding='utf-8') as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            header = None
+    if not isinstance(header, dict) or header.get("plan") != 1:
+        raise ValueError(f"{plan_path} is not a plan file.")
+    return header
+
+
+class PreflightReport:
+    # Outcome of a pre-flight pass: counts, the first max_problems problems
+    # (all of them are in report_path) and the payload stream that run()
+    # sends instead of re-reading the CSV while it still matches the file
+    # and the mapping.
+
+    def __init__(self, csv_path, stream_path, report_path, signature, max_problems=1000):
+        self.csv_path = csv_path
+        self.stream_path = stream_path
+        self.report_path = report_path
+        self.signature = signature
+        self.max_problems = max_problems
+        self.rows = 0
+        self.bad_cells = 0
+        self.bad_rows = 0
+        self.missing_keys = 0
+        self.problems = []
+        self.seconds = 0.0
+
+    def add_problem(self, row_index, csv_header, api_field, value, problem):
+        if len(self.problems) < self.max_problems:
+            self.problems.append((row_index, csv_header, api_field, value, problem))
+
+    def ok(self):
+        return not self.bad_cells and not self.missing_keys
+
+    def to_json(self):
+        return {
+            "rows": self.rows,
+            "bad_cells": self.bad_cells,
+            "bad_rows": self.bad_rows,
+            "missing_keys": self.missing_keys,
+            "report_file": self.report_path,
+            "payload_stream": self.stream_path,
+            "seconds": round(self.seconds, 3),
+        }
+
+
+class KeyScan:
+    # Every duplicated value of one key column: duplicates maps the value to
+    # all row indexes it is on, duplicate_rows maps each repeat to the row it
+    # repeats. Valid while the file is unchanged, so run() can use it instead
+    # of tracking keys itself.
+
+    def __init__(self, signature, rows, duplicates):
+        self.signature = signature
+        self.rows = rows
+        self.duplicates = duplicates
+        self.duplicate_rows = {row: rows_[0] for rows_ in duplicates.values() for row in rows_[1:]}
+
+    def describe(self, limit=10):
+        lines = [f"'{value}' on rows {', '.join(map(str, rows))}"
+                 for value, rows in itertools.islice(self.duplicates.items(), limit)]
+        if len(self.duplicates) > limit:
+            lines.append(f"... and {len(self.duplicates) - limit} more")
+        return "\n".join(lines)
+
+
+class ProgressMeter:
+    # Turns successive UpsertEngine.progress() snapshots into a smoothed
+    # rows/sec and an ETA. The ETA is by rows when the total is known (after
+    # a pre-flight or key scan), by bytes read otherwise.
+
+    def __init__(self, smoothing=0.3):
+        self.smoothing = smoothing
+        self.last = None
+        self.rate = None
+
+    def sample(self, snapshot):
+        if self.last is not None:
+            dt = snapshot["elapsed_seconds"] - self.last["elapsed_seconds"]
+            if dt > 0:
+                rate = (snapshot["rows_done"] - self.last["rows_done"]) / dt
+                self.rate = rate if self.rate is None else (
+                    self.smoothing * rate + (1 - self.smoothing) * self.rate)
+        self.last = snapshot
+        return dict(snapshot, rows_per_second=self.rate, eta_seconds=self.eta(snapshot),
+                    fraction_done=self.fraction_done(snapshot))
+
+    def fraction_done(self, snapshot):
+        if snapshot["rows_total"]:
+            return min(1.0, snapshot["rows_done"] / snapshot["rows_total"])
+        if snapshot["bytes_total"]:
+            return min(1.0, snapshot["bytes_read"] / snapshot["bytes_total"])
+        return None
+
+    def eta(self, snapshot):
+        fraction = self.fraction_done(snapshot)
+        if not self.rate or fraction is None:
+            return None
+        if snapshot["rows_total"]:
+            return max(0.0, (snapshot["rows_total"] - snapshot["rows_done"]) / self.rate)
+        if not fraction:
+            return None
+        # rows still to go, estimated from how many rows the bytes so far held
+        rows_left = snapshot["rows_done"] * (1 - fraction) / fraction
+        return rows_left / self.rate
+
+
+class ResultsSink:
+    # Streams per-row results to a CSV file while the run is going. Lines go
+    # out as rows finish, so a busy row never holds back the rows after it;
+    # the byte range of each row's line is kept and close() rewrites the file
+    # in CSV row order. In memory it only keeps a status code byte and a line
+    # position per row, running counters and the first max_errors error
+    # messages. When resuming, kept_rows maps the rows an earlier run already
+    # finished to their journaled action, and their lines are written from it.
+
+    fieldnames = ["row_index", "status", "error", "action"]
+    max_error_length = 500
+
+    def __init__(self, path, max_errors=1000, flush_every=100, kept_rows=None):
+        self.path = path
+        self.max_errors = max_errors
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.kept_rows = kept_rows or {}
+        self.file = open(path, "wb")
+        self.line = io.StringIO()
+        self.writer = csv.writer(self.line)
+        self.offset = 0
+        self.offsets = array('Q')
+        self.lengths = array('L')
+        self.ordered = True
+        self.last_row = -1
+        self.unflushed = 0
+        self.header_length = self._write_line(self.fieldnames)
+        # code 0 means "no result"; other codes index into outcomes
+        self.outcomes = [(None, None)]
+        self.codes = {}
+        self.statuses = array('B')
+        self.counts = Counter()
+        self.errors = {}
+
+    def record(self, row_index, status, error, action):
+        if error is not None:
+            error = error[:self.max_error_length]
+        with self.lock:
+            code = self.codes.get((status, action))
+            if code is None:
+                code = self.codes[(status, action)] = len(self.outcomes)
+                self.outcomes.append((status, action))
+            if row_index >= len(self.statuses):
+                self.statuses.frombytes(bytes(row_index + 1 - len(self.statuses)))
+            self.statuses[row_index] = code
+            self.counts[status] += 1
+            if error is not None and len(self.errors) < self.max_errors:
+                self.errors[row_index] = error
+            self._write_row(row_index, (row_index, status, error, action))
+
+    def skip_row(self, row_index):
+        # a row an earlier run finished: its line comes from the journal
+        with self.lock:
+            self._write_kept(row_index)
+
+    def _write_kept(self, row_index):
+        action = self.kept_rows[row_index]
+        status = {"skip": "skipped", "unchanged": "unchanged"}.get(action, "success")
+        self._write_row(row_index, (row_index, status, None, action))
+
+    def _write_line(self, fields):
+        self.line.seek(0)
+        self.line.truncate()
+        self.writer.writerow(fields)
+        data = self.line.getvalue().encode("utf-8")
+        self.file.write(data)
+        self.offset += len(data)
+        return len(data)
+
+    def _write_row(self, row_index, entry):
+        offset = self.offset
+        length = self._write_line(entry)
+        if row_index >= len(self.offsets):
+            grow = row_index + 1 - len(self.offsets)
+            self.offsets.frombytes(bytes(grow * self.offsets.itemsize))
+            self.lengths.frombytes(bytes(grow * self.lengths.itemsize))
+        self.offsets[row_index] = offset
+        self.lengths[row_index] = length
+        if row_index < self.last_row:
+            self.ordered = False
+        self.last_row = row_index
+        self.unflushed += 1
+        if self.unflushed >= self.flush_every:
+            self.file.flush()
+            self.unflushed = 0
+
+    def outcome(self, row_index):
+        if row_index >= len(self.statuses):
+            return (None, None)
+        return self.outcomes[self.statuses[row_index]]
+
+    def close(self):
+        with self.lock:
+            # kept rows the run never reached (it stopped early)
+            for row_index in sorted(self.kept_rows):
+                if row_index >= len(self.lengths) or not self.lengths[row_index]:
+                    self._write_kept(row_index)
+            self.file.close()
+            if not self.ordered:
+                self._sort()
+
+    def _sort(self):
+        sorted_path = f"{self.path}.sorting"
+        with open(self.path, "rb") as src, open(sorted_path, "wb") as dst:
+            with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                dst.write(data[:self.header_length])
+                for offset, length in zip(self.offsets, self.lengths):
+                    if length:
+                        dst.write(data[offset:offset + length])
+        os.replace(sorted_path, self.path)
+
+
+class Metrics:
+    # Cheap always-on instrumentation: fixed-bucket latency histograms per
+    # phase (lookup, prefetch, payload, create, update, row), retry counts,
+    # HTTP status distribution and a rows/sec timeline. Exported as JSON and
+    # Prometheus text at the end of a run.
+
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    max_timeline_points = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.histograms = {}
+        self.retries = Counter()
+        self.responses = Counter()
+        self.rows_done = 0
+        self.timeline = []
+        self.timeline_interval = 1.0
+        self.last_sample = self.started
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            hist = self.histograms.get(phase)
+            if hist is None:
+                hist = self.histograms[phase] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            hist["counts"][bisect.bisect_left(self.buckets, seconds)] += 1
+            hist["sum"] += seconds
+            hist["count"] += 1
+
+    def retry(self, phase):
+        with self.lock:
+            self.retries[phase] += 1
+
+    def response(self, method, status):
+        with self.lock:
+            self.responses[(method, str(status))] += 1
+
+    def row_done(self):
+        with self.lock:
+            self.rows_done += 1
+            now = time.monotonic()
+            if now - self.last_sample >= self.timeline_interval:
+                self.timeline.append((round(now - self.started, 2), self.rows_done))
+                self.last_sample = now
+                if len(self.timeline) > self.max_timeline_points:
+                    # keep long runs bounded: halve the resolution
+                    self.timeline = self.timeline[::2]
+                    self.timeline_interval *= 2
+
+    def quantile(self, phase, q):
+        # upper bound of the bucket holding the q-th observation
+        hist = self.histograms.get(phase)
+        if not hist or not hist["count"]:
+            return None
+        target = q * hist["count"]
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), hist["counts"]):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def rows_per_second(self):
+        elapsed = time.monotonic() - self.started
+        return self.rows_done / elapsed if elapsed > 0 else 0.0
+
+    def to_json(self):
+        with self.lock:
+            return {
+                "elapsed_seconds": round(time.monotonic() - self.started, 3),
+                "rows_done": self.rows_done,
+                "rows_per_second": round(self.rows_per_second(), 2),
+                "phases": {
+                    phase: {
+                        "count": hist["count"],
+                        "sum_seconds": round(hist["sum"], 6),
+                        "p50_seconds": self.quantile(phase, 0.5),
+                        "p99_seconds": self.quantile(phase, 0.99),
+                        "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], hist["counts"])),
+                    }
+                    for phase, hist in self.histograms.items()
+                },
+                "retries": dict(self.retries),
+                "responses": {f"{method} {status}": n for (method, status), n in self.responses.items()},
+                "timeline": self.timeline,
+            }
+
+    def to_prometheus(self):
+        with self.lock:
+            lines = [
+                "# HELP inv_phase_seconds Latency of each import phase.",
+                "# TYPE inv_phase_seconds histogram",
+            ]
+            for phase, hist in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip([str(b) for b in self.buckets] + ["+Inf"], hist["counts"]):
+                    cumulative += count
+                    lines.append(f'inv_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+                lines.append(f'inv_phase_seconds_sum{{phase="{phase}"}} {hist["sum"]}')
+                lines.append(f'inv_phase_seconds_count{{phase="{phase}"}} {hist["count"]}')
+            lines += ["# HELP inv_retries_total Requests retried, by phase.", "# TYPE inv_retries_total counter"]
+            lines += [f'inv_retries_total{{phase="{phase}"}} {n}' for phase, n in self.retries.items()]
+            lines += ["# HELP inv_http_responses_total HTTP responses by method and status.",
+                      "# TYPE inv_http_responses_total counter"]
+            lines += [f'inv_http_responses_total{{method="{method}",code="{status}"}} {n}'
+                      for (method, status), n in self.responses.items()]
+            lines += ["# HELP inv_rows_done_total Rows with a final result.", "# TYPE inv_rows_done_total counter",
+                      f"inv_rows_done_total {self.rows_done}",
+                      "# HELP inv_rows_per_second Average rows per second over the run.",
+                      "# TYPE inv_rows_per_second gauge",
+                      f"inv_rows_per_second {self.rows_per_second():.3f}"]
+            return "\n".join(lines) + "\n"
+
+    def describe(self):
+        # short human-readable view for the live metrics popup
+        data = self.to_json()
+        lines = [f"{data['rows_done']} rows, {data['rows_per_second']} rows/sec"]
+        for phase, hist in sorted(data["phases"].items()):
+            lines.append(f"{phase}: {hist['count']} calls, p50 <= {hist['p50_seconds']}s, p99 <= {hist['p99_seconds']}s")
+        if data["retries"]:
+            lines.append("retries: " + ", ".join(f"{k}={v}" for k, v in sorted(data["retries"].items())))
+        if data["responses"]:
+            lines.append("responses: " + ", ".join(f"{k}: {v}" for k, v in sorted(data["responses"].items())))
+        return "\n".join(lines)
+
+    def export(self, prefix):
+        with open(f"{prefix}.json", "w", encoding="utf-8") as f:
+            json.dump(self.to_json(), f, indent=2)
+        with open(f"{prefix}.prom", "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+
+
+class UpsertEngine:
+
+    def __init__(self, config_data, config_filename=None):
+        self.config_data = config_data
+        # where fetched schemas are cached between runs (None = memory only)
+        self.config_filename = config_filename
+        self.base_url = self.config_data.get("base_url", "")
+        self.endpoint = self.config_data.get("endpoint", "")
+        self.key_column = self.config_data.get("key_column", None)
+        self.field_mappings = self.config_data.get("field_mappings", {})
+        self.csv_path = None
+        self.session_token = None
+        # kept for the run so a 401 can log in again; auth_ready is cleared
+        # while that login is going so new requests wait for it
+        self.credentials = None
+        self.auth_lock = threading.Lock()
+        self.auth_ready = threading.Event()
+        self.auth_ready.set()
+        self.auth_failed = False
+        # set by JobScheduler: a connection pool and a request budget shared
+        # with the other jobs, and this job's name for fair scheduling
+        self.shared_adapter = None
+        self.request_gate = None
+        self.job_name = None
+        # optional token cache between runs, a 0600 file keyed by URL + user;
+        # each token is stored with a salted hash of the password it was
+        # issued for and only reused for the same password
+        self.token_cache_enabled = self.config_data.get("token_cache", False)
+        self.token_cache_path = os.path.expanduser(
+            self.config_data.get("token_cache_path", "~/.inv_token_cache.json"))
+        self.token_cache_ttl = self.config_data.get("token_cache_ttl", 3600)
+        # one pooled keep-alive session shared by every request-handler call
+        self.http = None
+        self.http_pool_size = self.config_data.get("http_pool_size", 10)
+        # 429, 5xx and connection errors are retried with jittered backoff or
+        # the server's Retry-After; rate_limit_per_second (0 = off) caps the
+        # request rate per base URL across all engines
+        self.max_retries = self.config_data.get("max_retries", 5)
+        self.backoff_factor = self.config_data.get("backoff_factor", 1)
+        self.max_retry_delay = self.config_data.get("max_retry_delay", 120)
+        self.rate_limit_per_second = self.config_data.get("rate_limit_per_second", 0)
+        self.rate_limit_burst = self.config_data.get("rate_limit_burst", None)
+        # Repeated keys come from a scan_keys() pass over the file. "inline"
+        # fails the repeats as they come up, "prescan" (app and CLI) refuses
+        # to start while there are any; anything else doesn't check.
+        self.duplicate_check = self.config_data.get("duplicate_check", "inline")
+        # set by scan_keys(); reused while it matches the file and key column
+        self.key_scan = None
+        self.current_row_index = 0
+        self.bytes_read = 0
+        self.bytes_total = 0
+        self.api_fields = {}
+        # field types are merged over a sample of schema_sample_size records
+        # and cached per base URL + endpoint for schema_cache_ttl seconds
+        self.schema_sample_size = self.config_data.get("schema_sample_size", 20)
+        self.schema_cache_ttl = self.config_data.get("schema_cache_ttl", 86400)
+        # (csv_header, api_field, converter) per mapped column, built by run()
+        self.compiled_mapping = None
+        # 0 converts row by row; N converts N rows at a time column by column
+        # and reports every bad cell in a row instead of only the first
+        self.conversion_batch_size = self.config_data.get("conversion_batch_size", 0)
+        # optional pre-flight: parse and convert the whole CSV in a process
+        # pool before sending anything, write a report of every bad cell and
+        # missing key, and send from the resulting payload stream
+        self.preflight_enabled = self.config_data.get("preflight", False)
+        self.preflight_workers = self.config_data.get("preflight_workers", None)
+        self.preflight_chunk_bytes = self.config_data.get("preflight_chunk_bytes", 4 * 1024 * 1024)
+        self.preflight_report = None
+        # per-row results stream to results_path (default: next to the CSV)
+        self.results = None
+        self.results_path = None
+        self.max_stored_errors = self.config_data.get("max_stored_errors", 1000)
+        # per-phase latency/retry/status metrics, written to
+        # <metrics_prefix>.json and .prom (default: next to the CSV) after a run
+        self.metrics = Metrics()
+        self.metrics_prefix = None
+        self.metrics_export = self.config_data.get("metrics_export", True)
+        self.row_started = {}
+        # finished rows are journaled next to the CSV so a crashed run can resume
+        self.journal_enabled = self.config_data.get("journal_enabled", True)
+        self.journal_flush_every = self.config_data.get("journal_flush_every", 50)
+        self.journal = None
+        self.resumed_rows = 0
+        # creates/updates run concurrently, one in flight per key value
+        self.max_workers = self.config_data.get("max_workers", 8)
+        # throttled rows that may wait for their retry without holding up
+        # the reader; beyond that, throttling slows the whole run down
+        self.max_parked_retries = self.config_data.get("max_parked_retries", 1000)
+        self.executor = None
+        # batch_size > 1 sends that many creates (POST) or updates (PUT) as
+        # one JSON array to the collection URL; a server that refuses arrays
+        # gets per-row requests for the rest of the run. Batches only go out
+        # when the keys are known to be unique (a key scan ran and repeats
+        # fail): a batch doesn't hold its rows' keys, so two rows with one
+        # key could otherwise be in flight at once
+        self.batch_size = self.config_data.get("batch_size", 0)
+        self.unique_keys = False
+        self.batching = False
+        self.batches = {}
+        self.batch_supported = {}
+        self.batch_lock = threading.Lock()
+        self.batch_ids = itertools.count()
+        # "prefetch" pages through the endpoint once and indexes key -> id,
+        # "per_row" does one GET per CSV row (for endpoints too big to index).
+        # Paging assumes the server takes ?skip=N&limit=M; one that pages
+        # some other way is detected (a full page with nothing new) and the
+        # run falls back to per-row lookups
+        self.key_lookup_mode = self.config_data.get("key_lookup_mode", "prefetch")
+        self.prefetch_page_size = self.config_data.get("prefetch_page_size", 1000)
+        self.prefetch_max_records = self.config_data.get("prefetch_max_records", 500000)
+        self.key_index = None
+        # per_row mode only: > 1 looks keys up N at a time with a repeated
+        # ?field=a&field=b filter when planning; 0 looks them up one by one
+        # (concurrently). The plan file is written plan_chunk_size rows at a time.
+        self.lookup_batch_size = self.config_data.get("lookup_batch_size", 0)
+        self.plan_chunk_size = self.config_data.get("plan_chunk_size", 1000)
+        # opt-in: updates whose mapped fields already match the server are not
+        # sent; key_fingerprints holds digests of the existing records' mapped values
+        self.skip_unchanged = self.config_data.get("skip_unchanged", False)
+        self.key_fingerprints = None
+        self.duplicate_policy = self.config_data.get("duplicate_policy", "ask")
+        # called as ask_existing(existing_id, key_value) -> "update" | "create"
+        # | "skip" under the "ask" policy; without it existing rows are updated
+        self.ask_existing = None
+        self.ask_lock = threading.Lock()
+
+    def job_profile(self):
+        # this engine's file, endpoint and mapping, to save as a job profile
+        return {
+            "csv_file": self.csv_path,
+            "endpoint": self.endpoint,
+            "key_column": self.key_column,
+            "field_mappings": dict(self.field_mappings),
+            "duplicate_policy": self.duplicate_policy,
+        }
+
+    def store_config(self):
+        self.config_data["base_url"] = self.base_url
+        self.config_data["endpoint"] = self.endpoint
+        self.config_data["key_column"] = self.key_column
+        self.config_data["field_mappings"] = self.field_mappings
+        self.config_data["duplicate_policy"] = self.duplicate_policy
+
+    #SESSION
+
+    def login(self, username, password, use_cache=True):
+        # use_cache=False always asks the server, for callers that need to
+        # know the credentials are good before they say so
+        self.open_http_session()
+        self.credentials = (username, password)
+        self.auth_failed = False
+        token = self.cached_token(username, password) if use_cache else None
+        if token:
+            # not checked here; if it has expired the first 401 logs in again
+            self.set_token(token)
+            return token
+        return self.authenticate(username, password)
+
+    def authenticate(self, username, password):
+        login_url = f"{self.base_url}/csi-requesthandler/api/v2/session"
+        response = self.http.post(
+            login_url,
+            json={"username": username, "password": password}
+        )
+        if response.status_code != 200:
+            raise ValueError(f"Login failed: {response.text}")
+        token = response.json().get('token')
+        if not token:
+            raise ValueError("Token not found in the login response.")
+        self.set_token(token)
+        self.store_cached_token(username, password, token)
+        return token
+
+    def set_token(self, token):
+        self.session_token = token
+        self.http.headers["Cookie"] = token
+
+    def reauthenticate(self, stale_token):
+        # Called by every request that got a 401. Only the first one logs in;
+        # the rest wait on the lock and then find a new token already set.
+        import requests
+        with self.auth_lock:
+            if self.session_token != stale_token:
+                return not self.auth_failed
+            if self.auth_failed or self.credentials is None:
+                return False
+            self.auth_ready.clear()
+            try:
+                print("Session expired, logging in again.")
+                self.authenticate(*self.credentials)
+                return True
+            except (ValueError, requests.exceptions.RequestException) as e:
+                print(f"Login again failed: {e}")
+                self.auth_failed = True
+                self.drop_cached_token(self.credentials[0])
+                return False
+            finally:
+                self.auth_ready.set()
+
+    #TOKEN CACHE
+
+    def token_cache_key(self, username):
+        return f"{self.base_url}|{username}"
+
+    def read_token_cache(self):
+        try:
+            with open(self.token_cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def write_token_cache(self, data):
+        # created 0600 from the start so the token is never world-readable
+        try:
+            fd = os.open(self.token_cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                if hasattr(os, "fchmod"):
+                    os.fchmod(f.fileno(), 0o600)
+                json.dump(data, f)
+        except OSError as e:
+            print(f"Could not write token cache: {e}")
+
+    @staticmethod
+    def password_hash(password, salt):
+        return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), bytes.fromhex(salt), 100000).hex()
+
+    def cached_token(self, username, password):
+        # a cached token is only handed to whoever knows the password it was
+        # issued for; entries without a password hash are never used
+        if not self.token_cache_enabled:
+            return None
+        entry = self.read_token_cache().get(self.token_cache_key(username))
+        if not entry or time.time() - entry.get("saved_at", 0) >= self.token_cache_ttl:
+            return None
+        salt, expected = entry.get("salt"), entry.get("password_hash")
+        if not salt or not expected:
+            return None
+        try:
+            actual = self.password_hash(password, salt)
+        except ValueError:
+            return None
+        if not hmac.compare_digest(actual, expected):
+            return None
+        return entry.get("token")
+
+    def store_cached_token(self, username, password, token):
+        if not self.token_cache_enabled:
+            return
+        data = self.read_token_cache()
+        salt = os.urandom(16).hex()
+        data[self.token_cache_key(username)] = {
+            "token": token,
+            "saved_at": time.time(),
+            "salt": salt,
+            "password_hash": self.password_hash(password, salt),
+        }
+        self.write_token_cache(data)
+
+    def drop_cached_token(self, username):
+        if not self.token_cache_enabled:
+            return
+        data = self.read_token_cache()
+        if data.pop(self.token_cache_key(username), None) is not None:
+            self.write_token_cache(data)
+
+    def open_http_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.close_http_session()
+        adapter = self.shared_adapter or HTTPAdapter(
+            pool_connections=self.http_pool_size, pool_maxsize=self.http_pool_size)
+        self.http = requests.Session()
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+        self.http.headers.update({"accept": "application/json", "Content-Type": "application/json"})
+
+    def close_http_session(self):
+        if self.http is not None:
+            # a shared connection pool belongs to the scheduler, not to us
+            if self.shared_adapter is None:
+                self.http.close()
+            self.http = None
+        self.session_token = None
+        self.credentials = None
+
+    def fetch_api_fields(self, refresh=False):
+        cache = self.config_data.setdefault("schema_cache", {})
+        cache_key = f"{self.base_url}|{self.endpoint}"
+        cached = cache.get(cache_key)
+        if (not refresh and cached and cached.get("fields")
+                and time.time() - cached.get("fetched_at", 0) < self.schema_cache_ttl):
+            self.api_fields = dict(cached["fields"])
+            self.compiled_mapping = None
+            return self.api_fields
+
+        full_url = f"{self.base_url}/csi-requesthandler/api/v2/{self.endpoint}?limit={self.schema_sample_size}"
+        success, resp = self._request_with_retry("GET", full_url, phase="schema", stream=True)
+        if not success:
+            raise ValueError(f"Failed to fetch data: {resp}")
+        if resp.status_code != 200:
+            raise ValueError(f"Failed to fetch data: {resp.status_code} - {resp.text}")
+        # endpoints that ignore limit still send everything; only the sample
+        # is read
+        items = iter_response_items(resp, whole=False)
+        try:
+            sample = list(itertools.islice(items, self.schema_sample_size))
+        finally:
+            items.close()
+        if not sample:
+            raise ValueError("No data found at the endpoint to deduce fields.")
+        self.api_fields = merge_field_types(sample)
+        self.compiled_mapping = None
+
+        cache[cache_key] = {"fields": self.api_fields, "fetched_at": time.time()}
+        if self.config_filename:
+            save_schema_cache(cache, self.config_filename)
+        return self.api_fields
+
+    #CSV
+
+    def read_csv_headers(self, file_path):
+        # only the header line is read here; rows are streamed later
+        with open(file_path, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.DictReader(f)
+            return reader.fieldnames or []
+
+    def iter_csv_rows(self, file_path):
+        # rows are read lazily so memory stays flat however big the file is
+        with open(file_path, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.DictReader(self.count_read(f, file_path))
+            for row_index, row in enumerate(reader):
+                yield row_index, row
+
+    def count_read(self, f, file_path):
+        # feeds progress(): characters read so far against the file size
+        # (the same thing for ASCII files, close enough otherwise)
+        self.bytes_total = os.path.getsize(file_path)
+        self.bytes_read = 0
+        for line in f:
+            self.bytes_read += len(line)
+            yield line
+
+    def file_signature(self, file_path):
+        stat = os.stat(file_path)
+        return (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+    def scan_keys(self, file_path, column_name):
+        # One pass that keeps an open-addressing table of 64-bit key hashes
+        # in a flat array instead of a set of key strings, so memory grows
+        # by 16 bytes per distinct key. Rows whose hash was seen before are
+        # candidates; they are confirmed (or dismissed as hash collisions)
+        # by comparing the actual values, which reads the key column again
+        # only when there is a candidate at all.
+        mask64 = (1 << 64) - 1
+        table = array('Q', bytes(8 * 1024))
+        used = 0
+        rows = 0
+        repeated = set()
+        for _, row in self.iter_csv_rows(file_path):
+            rows += 1
+            value = row.get(column_name) or ""
+            if not value:
+                continue
+            h = (hash(value) & mask64) or 1
+            slot_mask = len(table) - 1
+            slot = h & slot_mask
+            while True:
+                occupant = table[slot]
+                if occupant == 0:
+                    table[slot] = h
+                    used += 1
+                    break
+                if occupant == h:
+                    repeated.add(h)
+                    break
+                slot = (slot + 1) & slot_mask
+            if used * 2 > len(table):
+                table = self._grow_hash_table(table)
+        del table
+
+        duplicates = {}
+        if repeated:
+            groups = {}
+            for row_index, row in self.iter_csv_rows(file_path):
+                value = row.get(column_name) or ""
+                if value and ((hash(value) & mask64) or 1) in repeated:
+                    groups.setdefault(value, []).append(row_index)
+            duplicates = {value: rows_ for value, rows_ in groups.items() if len(rows_) > 1}
+        signature = self.file_signature(file_path) + (column_name,)
+        return KeyScan(signature, rows, duplicates)
+
+    def _grow_hash_table(self, table):
+        grown = array('Q', bytes(16 * len(table)))
+        slot_mask = len(grown) - 1
+        for h in table:
+            if h:
+                slot = h & slot_mask
+                while grown[slot]:
+                    slot = (slot + 1) & slot_mask
+                grown[slot] = h
+        return grown
+
+    def key_scan_current(self, file_path):
+        return (self.key_scan is not None
+                and self.key_scan.signature == self.file_signature(file_path) + (self.key_column,))
+
+    def find_duplicate_key(self, file_path, column_name):
+        self.key_scan = self.scan_keys(file_path, column_name)
+        return next(iter(self.key_scan.duplicates), None)
+
+    #PRE-FLIGHT
+
+    def preflight_signature(self, file_path):
+        # the stream is only valid for this exact file, key and mapping
+        mapping = tuple((h, f, convert.__name__) for h, f, convert in
+                        compile_mapping(self.field_mappings, self.api_fields))
+        return self.file_signature(file_path) + (self.key_column, mapping)
+
+    def preflight_current(self, file_path):
+        report = self.preflight_report
+        return (report is not None and os.path.exists(report.stream_path)
+                and report.signature == self.preflight_signature(file_path))
+
+    def preflight(self, file_path):
+        # multiprocessing is only loaded by the runs that use it
+        from concurrent.futures import ProcessPoolExecutor
+        started = time.perf_counter()
+        compiled_mapping = compile_mapping(self.field_mappings, self.api_fields)
+        fieldnames = self.read_csv_headers(file_path)
+        report = PreflightReport(
+            file_path, f"{file_path}.payloads.jsonl", f"{file_path}.preflight.csv",
+            self.preflight_signature(file_path), max_problems=self.max_stored_errors
+        )
+        ranges = csv_chunk_ranges(file_path, self.preflight_chunk_bytes)
+        tasks = [
+            (file_path, start, end, fieldnames, self.key_column, compiled_mapping,
+             f"{report.stream_path}.part{n}")
+            for n, (start, end) in enumerate(ranges)
+        ]
+
+        row_offset = 0
+        with ProcessPoolExecutor(max_workers=self.preflight_workers) as pool, \
+                open(report.stream_path, 'wb') as stream, \
+                open(report.report_path, 'w', newline='', encoding='utf-8') as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(["row_index", "column", "field", "value", "problem"])
+            # map() hands results back in chunk order, so parts are joined
+            # as soon as every earlier chunk is done
+            for task, (count, bad_cells, missing_keys) in zip(tasks, pool.map(preflight_chunk, tasks)):
+                part_path = task[-1]
+                with open(part_path, 'rb') as part:
+                    shutil.copyfileobj(part, stream)
+                os.remove(part_path)
+
+                problems = [(offset, csv_header, api_field, value, bad_cell_message(api_field, value))
+                            for offset, csv_header, api_field, value in bad_cells]
+                problems += [(offset, self.key_column, None, "", "No key value found in this row")
+                             for offset in missing_keys]
+                for offset, csv_header, api_field, value, problem in sorted(problems, key=lambda p: p[0]):
+                    writer.writerow([row_offset + offset, csv_header, api_field, value, problem])
+                    report.add_problem(row_offset + offset, csv_header, api_field, value, problem)
+
+                report.rows += count
+                report.bad_cells += len(bad_cells)
+                report.bad_rows += len({offset for offset, _, _, _ in bad_cells})
+                report.missing_keys += len(missing_keys)
+                row_offset += count
+
+        report.seconds = time.perf_counter() - started
+        self.preflight_report = report
+        print(f"Pre-flight checked {report.rows} rows in {report.seconds:.2f}s: "
+              f"{report.bad_cells} bad cells, {report.missing_keys} rows without a key")
+        return report
+
+    #PROCESS CSV
+
+    def journal_path(self, file_path):
+        return f"{file_path}.journal"
+
+    def journaled_row_count(self, file_path):
+        if not self.journal_enabled:
+            return 0
+        return len(RunJournal.load(self.journal_path(file_path), self.endpoint, self.file_signature(file_path)))
+
+    def run(self, file_path, on_progress=None, resume=False, plan_path=None):
+        # with plan_path the rows come from a plan written by plan() instead
+        # of the CSV: nothing is converted or looked up, only sent
+        self.csv_path = file_path
+        self.current_row_index = 0
+        self.metrics = Metrics()
+        self.row_started = {}
+        self.results = None
+        if self.key_scan is not None and not self.key_scan_current(file_path):
+            self.key_scan = None
+        self.resumed_rows = 0
+        self.bytes_read = 0
+        self.bytes_total = 0
+        self.executor = None
+        self.journal = None
+        completed = False
+        try:
+            if self.journal_enabled:
+                # row indexes are positions in whatever the rows are read from
+                self.journal = RunJournal(
+                    self.journal_path(file_path), self.endpoint, self.file_signature(plan_path or file_path),
+                    flush_every=self.journal_flush_every, resume=resume
+                )
+            # the journal decides what resuming keeps, so the results follow it
+            self.results = ResultsSink(self.results_path or self.default_results_path(file_path),
+                                       max_errors=self.max_stored_errors,
+                                       kept_rows=self.journal.done_rows if self.journal else None)
+            if plan_path is None:
+                self.prepare_rows(file_path)
+            else:
+                self.unique_keys = bool(read_plan_header(plan_path).get("unique_keys"))
+            self.batching = self.batch_size > 1 and self.unique_keys
+            if self.batch_size > 1 and not self.unique_keys:
+                print("Batching is off: keys were not checked for duplicates "
+                      "(duplicate_check), sending rows one by one.")
+            self.executor = KeyedExecutor(self.max_workers, max_parked=self.max_parked_retries)
+            self.batches = {"create": [], "update": []}
+            self.batch_supported = {}
+
+            if plan_path is None:
+                for row_index, row, payload, error in self.iter_payloads(file_path):
+                    self.current_row_index = row_index
+                    if error is not None:
+                        self.log_result(row_index, "fail", f"Data conversion error: {error}", None)
+                    else:
+                        self.process_row(row_index, row, payload)
+                    if on_progress and row_index % 50 == 0:
+                        on_progress(row_index + 1)
+            else:
+                for entry in self.iter_plan(plan_path):
+                    self.current_row_index = entry[0]
+                    self.apply_entry(*entry)
+                    if on_progress and entry[0] % 50 == 0:
+                        on_progress(entry[0] + 1)
+            # rows still being looked up may add to the batches
+            self.executor.wait()
+            for action in self.batches:
+                self.flush_batch(action)
+            completed = True
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+            if self.journal is not None:
+                # a clean run needs no resume; keep the journal otherwise so
+                # the next run only retries what failed or never ran
+                if completed and not self.results.counts["fail"]:
+                    self.journal.discard()
+                else:
+                    self.journal.close()
+                self.journal = None
+            if self.results is not None:
+                self.results.close()
+            if self.metrics_export:
+                try:
+                    self.metrics.export(self.metrics_prefix or self.default_metrics_prefix(file_path))
+                except OSError as e:
+                    print(f"Could not write metrics: {e}")
+
+    def prepare_rows(self, file_path):
+        # everything a pass over the rows needs before the first one
+        if self.preflight_enabled and not self.preflight_current(file_path):
+            self.preflight(file_path)
+        if self.duplicate_check in ("inline", "prescan") and self.key_scan is None:
+            self.key_scan = self.scan_keys(file_path, self.key_column)
+        # check_key() fails every repeat the scan found
+        self.unique_keys = self.key_scan is not None
+        self.compiled_mapping = compile_mapping(self.field_mappings, self.api_fields)
+        self.key_index = None
+        self.key_fingerprints = None
+        # "always create" never needs to know what already exists
+        if self.key_lookup_mode == "prefetch" and self.duplicate_policy != "create":
+            self.key_index = self.build_key_index()
+
+    #PLAN/APPLY
+
+    def default_plan_path(self, file_path):
+        return f"{file_path}.plan.jsonl"
+
+    def plan(self, file_path, plan_path=None):
+        # Dry run: convert every row and resolve every key, but write
+        # nothing to the server. The plan is one JSON line per row,
+        # [row_index, action, id, key, payload, error], after a header line;
+        # action is create, update, unchanged, skip or invalid.
+        plan_path = plan_path or self.default_plan_path(file_path)
+        self.csv_path = file_path
+        self.metrics = Metrics()
+        if self.key_scan is not None and not self.key_scan_current(file_path):
+            self.key_scan = None
+        self.prepare_rows(file_path)
+
+        counts = Counter()
+        header = {
+            "plan": 1,
+            "csv_file": os.path.abspath(file_path),
+            "endpoint": self.endpoint,
+            "key_column": self.key_column,
+            "duplicate_policy": self.duplicate_policy,
+            "unique_keys": self.unique_keys,
+            "created_at": time.time(),
+        }
+        # written aside and moved into place, so a plan that stopped half way
+        # (a failed lookup) can't be applied
+        partial_path = f"{plan_path}.partial"
+        try:
+            with open(partial_path, 'w', encoding='utf-8') as out:
+                out.write(json.dumps(header) + "\n")
+                chunk = []
+                for item in self.iter_payloads(file_path):
+                    chunk.append(item)
+                    if len(chunk) >= self.plan_chunk_size:
+                        self.plan_chunk(chunk, out, counts)
+                        chunk = []
+                if chunk:
+                    self.plan_chunk(chunk, out, counts)
+            os.replace(partial_path, plan_path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        print(f"Plan written to {plan_path}: {dict(counts)}")
+        return dict(counts, plan_file=plan_path)
+
+    def plan_chunk(self, chunk, out, counts):
+        entries = []
+        keys = []
+        for row_index, row, payload, error in chunk:
+            key_value = row.get(self.key_column) or ""
+            if error is not None:
+                entries.append([row_index, "invalid", None, key_value, None, f"Data conversion error: {error}"])
+                continue
+            problem = self.check_key(row_index, key_value)
+            if problem is not None:
+                entries.append([row_index, "invalid", None, key_value, None, problem])
+                continue
+            entries.append([row_index, None, None, key_value, payload, None])
+            keys.append(key_value)
+
+        started = time.perf_counter()
+        existing = self.lookup_keys(keys) if keys and self.duplicate_policy != "create" else {}
+        self.metrics.observe("plan_lookup", time.perf_counter() - started)
+        for entry in entries:
+            if entry[1] is None:
+                existing_id, existing_fingerprint = existing.get(entry[3], (None, None))
+                entry[1] = self.choose_action(existing_id, existing_fingerprint, entry[3], entry[4], ask=False)
+                if entry[1] != "create":
+                    entry[2] = existing_id
+                if entry[1] in ("unchanged", "skip"):
+                    entry[4] = None
+            counts[entry[1]] += 1
+            out.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def apply_plan(self, plan_path, on_progress=None, resume=False):
+        # Executes a plan: every lookup is already done, so rows go straight
+        # to the executor. Results, journal and metrics sit next to the CSV
+        # the plan was made from, as for a normal run.
+        header = read_plan_header(plan_path)
+        if header["endpoint"] != self.endpoint:
+            raise ValueError(f"Plan is for endpoint '{header['endpoint']}', not '{self.endpoint}'.")
+        return self.run(header["csv_file"], on_progress, resume, plan_path=plan_path)
+
+    def iter_plan(self, plan_path):
+        with open(plan_path, 'r', encoding='utf-8') as f:
+            lines = self.count_read(f, plan_path)
+            next(lines)
+            for line in lines:
+                entry = json.loads(line)
+                if not self.skip_done_row(entry[0], entry[3]):
+                    yield entry
+
+    def apply_entry(self, row_index, action, record_id, key_value, payload, error):
+        self.row_started[row_index] = time.perf_counter()
+        if action in ("create", "update"):
+            self.dispatch(action, row_index, key_value, record_id, payload)
+        elif action == "unchanged":
+            self.log_result(row_index, "unchanged", None, "unchanged", record_id)
+        elif action == "skip":
+            self.log_result(row_index, "skipped", None, "skip")
+        else:
+            self.log_result(row_index, "fail", error, None)
+
+    def skip_done_row(self, row_index, key_value):
+        # rows journaled by an earlier run are not sent again
+        if self.journal is None or row_index not in self.journal.done_rows:
+            return False
+        self.resumed_rows += 1
+        self.results.skip_row(row_index)
+        return True
+
+    def iter_pending_rows(self, file_path):
+        for row_index, row in self.iter_csv_rows(file_path):
+            if not self.skip_done_row(row_index, row.get(self.key_column)):
+                yield row_index, row
+
+    def iter_preflight_payloads(self, stream_path):
+        # payloads were converted by the pre-flight; only the key is needed
+        # from the row itself
+        with open(stream_path, 'r', encoding='utf-8') as f:
+            for row_index, line in enumerate(self.count_read(f, stream_path)):
+                key_value, payload, error = json.loads(line)
+                if not self.skip_done_row(row_index, key_value):
+                    yield row_index, {self.key_column: key_value}, payload, error
+
+    def iter_payloads(self, file_path):
+        if self.preflight_current(file_path):
+            yield from self.iter_preflight_payloads(self.preflight_report.stream_path)
+            return
+
+        rows = self.iter_pending_rows(file_path)
+        if not self.conversion_batch_size:
+            for row_index, row in rows:
+                started = time.perf_counter()
+                try:
+                    payload = self.build_payload(row)
+                except (TypeError, ValueError) as e:
+                    yield row_index, row, None, str(e)
+                    continue
+                self.metrics.observe("payload", time.perf_counter() - started)
+                yield row_index, row, payload, None
+            return
+
+        chunk = []
+        for item in rows:
+            chunk.append(item)
+            if len(chunk) >= self.conversion_batch_size:
+                yield from self._convert_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield from self._convert_chunk(chunk)
+
+    def _convert_chunk(self, chunk):
+        started = time.perf_counter()
+        payloads, bad_cells = self.convert_rows([row for _, row in chunk])
+        self.metrics.observe("payload_batch", time.perf_counter() - started)
+        errors = {}
+        for offset, csv_header, api_field, value in bad_cells:
+            errors.setdefault(offset, []).append(bad_cell_message(api_field, value))
+        for offset, (row_index, row) in enumerate(chunk):
+            if offset in errors:
+                yield row_index, row, None, "; ".join(errors[offset])
+            else:
+                yield row_index, row, payloads[offset], None
+
+    def process_row(self, row_index, row, payload):
+        self.row_started[row_index] = time.perf_counter()
+        key_value = row.get(self.key_column, None)
+        problem = self.check_key(row_index, key_value)
+        if problem is not None:
+            self.log_result(row_index, "fail", problem, None)
+            return
+
+        # the lookup runs in the row's executor task, so this thread only
+        # reads rows and lookups go as wide as the writes
+        self.submit_task(key_value, (row_index,), self.lookup_and_send, row_index, key_value, payload)
+
+    def lookup_and_send(self, row_index, key_value, payload, attempt=0):
+        # Executor task: find the existing record, decide, then write, all
+        # under the row's key. A throttled lookup comes back as a Retry like
+        # a throttled write instead of sleeping.
+        url = self.key_lookup_url(self.key_column, key_value)
+        if self.duplicate_policy == "create":
+            existing_id, existing_fingerprint = None, None
+        elif self.key_index is not None or url is None:
+            existing_id, existing_fingerprint = self.lookup_existing(key_value)
+        else:
+            resp, error, retry_delay = self._attempt_request("GET", url, attempt=attempt, stream=True)
+            if retry_delay is not None:
+                if resp is not None:
+                    resp.close()
+                return Retry(retry_delay, self.lookup_and_send, row_index, key_value, payload, attempt + 1)
+            record = self.record_from_lookup(error is None, resp if error is None else error, key_value)
+            existing_id, existing_fingerprint = self.existing_from_record(record)
+        action = self.choose_action(existing_id, existing_fingerprint, key_value, payload)
+
+        if action == "unchanged":
+            self.log_result(row_index, "unchanged", None, "unchanged", existing_id)
+        elif action == "skip":
+            self.log_result(row_index, "skipped", None, "skip")
+        elif self.batching and self.batch_supported.get(action, True):
+            full = self.queue_batch(action, row_index, existing_id, payload)
+            if full:
+                return self.guarded(batch_rows(full), self.send_batch, action, full)
+        elif action == "update":
+            return self.update_record(existing_id, payload, row_index)
+        else:
+            return self.create_record(payload, row_index)
+        return None
+
+    def check_key(self, row_index, key_value):
+        # -> why this row can't be sent, or None
+        if not key_value:
+            return "No key value found in this row"
+        if self.key_scan is not None:
+            first_row = self.key_scan.duplicate_rows.get(row_index)
+            if first_row is not None:
+                return f"Duplicate key '{key_value}' earlier in this file (row {first_row})"
+        return None
+
+    def choose_action(self, existing_id, existing_fingerprint, key_value, payload, ask=True):
+        if existing_id is None:
+            return "create"
+        if (existing_fingerprint is not None and self.duplicate_policy in ("ask", "update")
+                and existing_fingerprint == self.payload_fingerprint(payload)):
+            # nothing to write, and nothing to ask about
+            return "unchanged"
+        if not ask and self.duplicate_policy == "ask":
+            return "update"
+        return self.resolve_existing(existing_id, key_value)
+
+    def dispatch(self, action, row_index, key_value, existing_id, payload):
+        if self.batching and self.batch_supported.get(action, True):
+            full = self.queue_batch(action, row_index, existing_id, payload)
+            if full:
+                self.submit_batch(action, full)
+        elif action == "update":
+            self.submit_task(key_value, (row_index,), self.update_record, existing_id, payload, row_index)
+        else:
+            self.submit_task(key_value, (row_index,), self.create_record, payload, row_index)
+
+    def submit_task(self, key, rows, fn, *args):
+        self.executor.submit(key, self.guarded, rows, fn, *args)
+
+    def guarded(self, rows, fn, *args):
+        # Executor task wrapper. A task that raises fails its rows that have
+        # no result yet; a row without one would hold up the results file
+        # (written in row order) for the rest of the run.
+        try:
+            result = fn(*args)
+        except Exception as e:
+            for row_index in rows:
+                if self.results.outcome(row_index)[0] is None:
+                    self.log_result(row_index, "fail", f"Unexpected error: {e}", None)
+            return None
+        if isinstance(result, Retry):
+            return Retry(result.delay, self.guarded, rows, result.fn, *result.args)
+        return result
+
+    def resolve_existing(self, existing_id, key_value):
+        if self.duplicate_policy in ("update", "create", "skip"):
+            return self.duplicate_policy
+        if self.ask_existing is not None:
+            # rows are decided on several workers; one question at a time
+            with self.ask_lock:
+                return self.ask_existing(existing_id, key_value)
+        return "update"
+
+    def build_key_index(self):
+        api_field_for_key = self.field_mappings.get(self.key_column)
+        if not api_field_for_key:
+            return None
+
+        url = f"{self.base_url}/csi-requesthandler/api/v2/{self.endpoint}"
+
+        index = {}
+        fingerprints = {} if self.skip_unchanged else None
+        skip = 0
+        page_size = self.prefetch_page_size
+        first_ids = set()
+        while True:
+            page_url = f"{url}?skip={skip}&limit={page_size}"
+            success, result = self._request_with_retry("GET", page_url, phase="prefetch", stream=True)
+            if not success or result.status_code != 200:
+                detail = result if not success else f"{result.status_code} - {result.text}"
+                print(f"Key index prefetch failed, using per-row lookups: {detail}")
+                return None
+
+            # records are indexed as they are parsed, never as a whole page
+            items = iter_response_items(result, whole=False)
+            count = 0
+            known = len(index)
+            repeated = False
+            try:
+                for record in items:
+                    count += 1
+                    if count == 1:
+                        repeated = record.get("id") is not None and record.get("id") in first_ids
+                        first_ids.add(record.get("id"))
+                        if repeated:
+                            break
+                    key = record.get(api_field_for_key)
+                    if key is not None and str(key) not in index:
+                        # keep the first match, same as the per-row lookup
+                        index[str(key)] = record.get("id")
+                        if fingerprints is not None:
+                            fingerprints[str(key)] = self.record_fingerprint(record)
+                    if len(index) > self.prefetch_max_records:
+                        print(f"Endpoint has more than {self.prefetch_max_records} records, "
+                              f"using per-row lookups.")
+                        return None
+            finally:
+                items.close()
+
+            # the same page again means skip/limit is not how this server
+            # pages, and asking for the next one would never end
+            if repeated or (count == page_size and len(index) == known):
+                print(f"Key index prefetch got the same records again at skip={skip} "
+                      f"(server does not page with skip/limit?), using per-row lookups.")
+                return None
+            # a short page is the last one; an oversized page means the
+            # server ignored skip/limit and sent the whole collection
+            if count != page_size:
+                break
+            skip += count
+
+        print(f"Prefetched {len(index)} keys from {self.endpoint}")
+        self.key_fingerprints = fingerprints
+        return index
+
+    def mapped_api_fields(self):
+        return tuple(api_field for _, api_field, _ in self.compiled_mapping)
+
+    def payload_fingerprint(self, payload):
+        return fingerprint(payload.get(f) for f in self.mapped_api_fields())
+
+    def record_fingerprint(self, record):
+        if self.compiled_mapping is None:
+            self.compiled_mapping = compile_mapping(self.field_mappings, self.api_fields)
+        return fingerprint(record.get(f) for f in self.mapped_api_fields())
+
+    def lookup_existing(self, key_value, strict=False):
+        # -> (existing id or None, fingerprint of its mapped fields or None)
+        if self.key_index is not None:
+            fingerprints = self.key_fingerprints or {}
+            return self.key_index.get(key_value), fingerprints.get(key_value)
+        return self.existing_from_record(self.fetch_record_by_key_value(self.key_column, key_value, strict))
+
+    def existing_from_record(self, record):
+        if record is None:
+            return None, None
+        if not self.skip_unchanged:
+            return record.get("id"), None
+        return record.get("id"), self.record_fingerprint(record)
+
+    def lookup_existing_id(self, key_value):
+        return self.lookup_existing(key_value)[0]
+
+    def lookup_keys(self, keys):
+        # -> {key: (existing id or None, fingerprint or None)} for many keys
+        # at once: from the prefetched index, in batches, or one by one on a
+        # thread pool. A lookup that fails raises either way, since planning
+        # a create for a key we couldn't check would be wrong.
+        if self.key_index is not None:
+            fingerprints = self.key_fingerprints or {}
+            return {k: (self.key_index.get(k), fingerprints.get(k)) for k in keys}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            if self.lookup_batch_size > 1:
+                size = self.lookup_batch_size
+                found = {}
+                for part in pool.map(self.fetch_records_by_key_values,
+                                     [keys[i:i + size] for i in range(0, len(keys), size)]):
+                    found.update(part)
+                return {k: found.get(k, (None, None)) for k in keys}
+            return dict(zip(keys, pool.map(lambda k: self.lookup_existing(k, strict=True), keys)))
+
+    def fetch_records_by_key_values(self, key_values):
+        # one GET for several keys; a lookup that fails raises
+        api_field_for_key = self.field_mappings.get(self.key_column)
+        if not api_field_for_key:
+            return {}
+        url = (f"{self.base_url}/csi-requesthandler/api/v2/{self.endpoint}?"
+               + urlencode([(api_field_for_key, v) for v in key_values]))
+        success, resp = self._request_with_retry("GET", url, stream=True)
+        if not success:
+            raise ValueError(f"Key lookup failed: {resp}")
+        if resp.status_code != 200:
+            raise ValueError(f"Key lookup failed: {resp.status_code} - {resp.text}")
+        wanted = set(key_values)
+        found = {}
+        items = iter_response_items(resp)
+        try:
+            for record in items:
+                key = str(record.get(api_field_for_key))
+                if key not in wanted:
+                    raise ValueError("The endpoint ignored the multi-key filter; set lookup_batch_size to 0.")
+                if key not in found:
+                    fingerprint_ = self.record_fingerprint(record) if self.skip_unchanged else None
+                    found[key] = (record.get("id"), fingerprint_)
+        finally:
+            items.close()
+        return found
+
+    def fetch_id_by_key_value(self, key_column, key_value):
+        record = self.fetch_record_by_key_value(key_column, key_value)
+        return record.get("id") if record is not None else None
+
+    def key_lookup_url(self, key_column, key_value):
+        api_field_for_key = self.field_mappings.get(key_column)
+        if not api_field_for_key:
+            return None
+        return f"{self.base_url}/csi-requesthandler/api/v2/{self.endpoint}?{api_field_for_key}={key_value}"
+
+    def fetch_record_by_key_value(self, key_column, key_value, strict=False):
+        url = self.key_lookup_url(key_column, key_value)
+        if url is None:
+            return None
+        success, result = self._request_with_retry("GET", url, stream=True)
+        return self.record_from_lookup(success, result, key_value, strict)
+
+    def record_from_lookup(self, success, result, key_value, strict=False):
+        # a failed lookup reads as "no record" unless strict, where it raises
+        if not success:
+            if strict:
+                raise ValueError(f"Key lookup failed for '{key_value}': {result}")
+            print(f"Fetch ID request failed: {result}")
+            return None
+
+        resp = result
+        if resp.status_code == 200:
+            # only the first match is used; the rest of the body isn't parsed
+            record = first_json_item(resp)
+            return record if isinstance(record, dict) else None
+        else:
+            if strict:
+                raise ValueError(f"Key lookup failed for '{key_value}': {resp.status_code} - {resp.text}")
+            resp.close()
+            return None
+
+    def build_payload(self, row):
+        if self.compiled_mapping is None:
+            self.compiled_mapping = compile_mapping(self.field_mappings, self.api_fields)
+        payload = {}
+        for csv_header, api_field, convert in self.compiled_mapping:
+            csv_value = row.get(csv_header, "")
+            try:
+                payload[api_field] = convert(csv_value)
+            except (TypeError, ValueError):
+                raise ValueError(bad_cell_message(api_field, csv_value)) from None
+        return payload
+
+    def convert_rows(self, rows):
+        if self.compiled_mapping is None:
+            self.compiled_mapping = compile_mapping(self.field_mappings, self.api_fields)
+        return convert_columns(self.compiled_mapping, rows)
+
+    #C/U
+
+    # create_record and update_record return a Retry when the row should be
+    # sent again later, otherwise whether it went through
+
+    def create_record(self, payload, row_index, attempt=0):
+        url = f"{self.base_url}/csi-requesthandler/api/v2/{self.endpoint}"
+
+        resp, error, retry_delay = self._attempt_request("POST", url, json=payload, attempt=attempt)
+        if retry_delay is not None:
+            return Retry(retry_delay, self.create_record, payload, row_index, attempt + 1)
+        if error is None:
+            #200 or 201 as success
+            if resp.status_code in (200, 201):
+                self.log_result(row_index, "success", None, "create", self.returned_id(resp))
+                return True
+            self.log_result(row_index, "fail", f"Create error: {resp.status_code} - {resp.text}", "create")
+        else:
+            self.log_result(row_index, "fail", f"Create request exception: {error}", "create")
+        return False
+
+    def update_record(self, resource_id, payload, row_index, attempt=0):
+        url = f"{self.base_url}/csi-requesthandler/api/v2/{self.endpoint}/{resource_id}"
+
+        resp, error, retry_delay = self._attempt_request("PUT", url, json=payload, attempt=attempt)
+        if retry_delay is not None:
+            return Retry(retry_delay, self.update_record, resource_id, payload, row_index, attempt + 1)
+        if error is None:
+            if resp.status_code in (200, 201):
+                self.log_result(row_index, "success", None, "update", resource_id)
+                return True
+            self.log_result(row_index, "fail", f"Update error: {resp.status_code} - {resp.text}", "update")
+        else:
+            self.log_result(row_index, "fail", f"Update request exception: {error}", "update")
+        return False
+
+    #BATCHES
+
+    def queue_batch(self, action, row_index, existing_id, payload):
+        # -> the batch, once this row fills it; the caller sends it. Rows are
+        # queued from executor tasks, which send a full batch themselves
+        # rather than submit (and maybe wait on) another task.
+        with self.batch_lock:
+            batch = self.batches[action]
+            batch.append((row_index, existing_id, payload))
+            if len(batch) < self.batch_size:
+                return None
+            self.batches[action] = []
+        return batch
+
+    def flush_batch(self, action):
+        with self.batch_lock:
+            items = self.batches[action]
+            self.batches[action] = []
+        if items:
+            self.submit_batch(action, items)
+
+    def submit_batch(self, action, items):
+        # only reached when keys are unique (see batching), so a batch only
+        # needs a key of its own
+        self.submit_task(("batch", next(self.batch_ids)), batch_rows(items), self.send_batch, action, items)
+
+    def batch_request(self, action, items):
+        url = f"{self.base_url}/csi-requesthandler/api/v2/{self.endpoint}"
+        if action == "update":
+            return "PUT", url, [dict(payload, id=existing_id) for _, existing_id, payload in items]
+        return "POST", url, [payload for _, _, payload in items]
+
+    def send_batch(self, action, items, attempt=0):
+        method, url, body = self.batch_request(action, items)
+        resp, error, retry_delay = self._attempt_request(method, url, json=body, attempt=attempt,
+                                                         phase=f"{action}_batch")
+        if retry_delay is not None:
+            return Retry(retry_delay, self.send_batch, action, items, attempt + 1)
+        if error is not None:
+            for row_index, _, _ in items:
+                self.log_result(row_index, "fail", f"Batch {action} request exception: {error}", action)
+            return
+        self.settle_batch(action, items, resp)
+
+    def settle_batch(self, action, items, resp):
+        if resp.status_code in (200, 201):
+            self.log_batch_results(action, items, resp)
+        elif resp.status_code in (404, 405, 415, 501):
+            # the endpoint doesn't take arrays at all
+            self.stop_batching(action, f"status {resp.status_code}")
+            self.send_singles(action, items)
+        elif not self.batch_supported.get(action, True):
+            # refused before we found out arrays don't work; no point splitting
+            self.send_singles(action, items)
+        else:
+            self.split_batch(action, items)
+
+    def stop_batching(self, action, reason):
+        with self.batch_lock:
+            if self.batch_supported.get(action, True):
+                print(f"Batch {action} not supported ({reason}), sending rows one by one.")
+            self.batch_supported[action] = False
+
+    def send_singles(self, action, items):
+        return [self.send_single(action, item) for item in items]
+
+    def split_batch(self, action, items):
+        # the server refused the batch, most likely over one bad row: halve
+        # it until the bad rows are on their own. Runs on the worker thread,
+        # so retries here sleep instead of going back to the executor.
+        if len(items) <= 2:
+            # a refused pair whose rows both go through on their own means
+            # the server doesn't take arrays (a 400 "expected an object")
+            if all(self.send_singles(action, items)) and len(items) == 2:
+                self.stop_batching(action, "a batch of 2 was refused but each row was accepted")
+            return
+        middle = len(items) // 2
+        for half in (items[:middle], items[middle:]):
+            if not self.batch_supported.get(action, True):
+                self.send_singles(action, half)
+                continue
+            method, url, body = self.batch_request(action, half)
+            success, result = self._request_with_retry(method, url, json=body, phase=f"{action}_batch")
+            if not success:
+                for row_index, _, _ in half:
+                    self.log_result(row_index, "fail", f"Batch {action} request exception: {result}", action)
+            else:
+                self.settle_batch(action, half, result)
+
+    def send_single(self, action, item):
+        row_index, existing_id, payload = item
+        if action == "update":
+            result = self.update_record(existing_id, payload, row_index)
+        else:
+            result = self.create_record(payload, row_index)
+        while isinstance(result, Retry):
+            time.sleep(result.delay)
+            result = result.fn(*result.args)
+        return result
+
+    def log_batch_results(self, action, items, resp):
+        # per-item results come back in request order; an item carrying an
+        # "error" failed on its own
+        try:
+            data = resp.json()
+        except ValueError:
+            data = None
+        if not isinstance(data, list) or len(data) != len(items):
+            data = [None] * len(items)
+        for (row_index, existing_id, _), result in zip(items, data):
+            if isinstance(result, dict) and result.get("error"):
+                self.log_result(row_index, "fail", f"Batch {action} error: {result['error']}", action)
+            elif action == "update":
+                self.log_result(row_index, "success", None, action, existing_id)
+            else:
+                record_id = result.get("id") if isinstance(result, dict) else None
+                self.log_result(row_index, "success", None, action, record_id)
+
+    def returned_id(self, resp):
+        try:
+            data = resp.json()
+        except ValueError:
+            return None
+        return data.get("id") if isinstance(data, dict) else None
+
+    def log_result(self, row_index, status, error, action, record_id=None):
+        self.results.record(row_index, status, error, action)
+        started = self.row_started.pop(row_index, None)
+        if started is not None:
+            self.metrics.observe("row", time.perf_counter() - started)
+        self.metrics.row_done()
+        if status != "fail" and self.journal is not None:
+            self.journal.record(row_index, action, record_id)
+
+    def _attempt_request(self, method, url, headers=None, json=None, attempt=0, phase=None, stream=False):
+        # One try. Returns (resp, error, retry_delay); retry_delay is set when
+        # the request should be sent again after that many seconds. With
+        # stream the body is left for the caller to read (and close).
+        import requests
+        method = method.upper()
+        if method not in ("POST", "PUT", "GET"):
+            return None, ValueError(f"Unsupported HTTP method: {method}"), None
+        phase = phase or {"GET": "lookup", "POST": "create", "PUT": "update"}[method]
+
+        limiter = rate_limiter_for(self.base_url, self.rate_limit_per_second, self.rate_limit_burst)
+        if limiter is not None:
+            limiter.acquire()
+
+        can_retry = attempt < self.max_retries - 1
+        self.auth_ready.wait()
+        token = self.session_token
+        gate = self.request_gate
+        if gate is not None:
+            gate.acquire(self.job_name)
+        started = time.perf_counter()
+        try:
+            resp = self.http.request(method, url, headers=headers, json=json, stream=stream)
+            if resp.status_code == 401 and self.reauthenticate(token):
+                # replayed once with the new token; a second 401 is real
+                self.metrics.response(method, resp.status_code)
+                self.metrics.retry(phase)
+                resp.close()
+                resp = self.http.request(method, url, headers=headers, json=json, stream=stream)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            self.metrics.response(method, "error")
+            if can_retry:
+                self.metrics.retry(phase)
+                return None, e, self.retry_delay(attempt)
+            return None, e, None
+        except Exception as e:
+            self.metrics.response(method, "error")
+            return None, e, None
+        finally:
+            if gate is not None:
+                gate.release()
+        self.metrics.observe(phase, time.perf_counter() - started)
+        self.metrics.response(method, resp.status_code)
+
+        # Retry on 429 and 5xx
+        if resp.status_code == 429 or 500 <= resp.status_code < 600:
+            if can_retry:
+                self.metrics.retry(phase)
+                return resp, None, self.retry_delay(attempt, resp)
+            resp.close()
+            return None, f"Request failed after {self.max_retries} attempts ({resp.status_code}).", None
+        return resp, None, None
+
+    def retry_delay(self, attempt, resp=None):
+        retry_after = parse_retry_after(resp.headers.get("Retry-After")) if resp is not None else None
+        if retry_after is not None:
+            # a little jitter so throttled rows don't all come back at once
+            delay = retry_after + random.uniform(0, self.backoff_factor)
+        else:
+            backoff = self.backoff_factor * (2 ** attempt)
+            delay = backoff / 2 + random.uniform(0, backoff / 2)
+        return min(delay, self.max_retry_delay)
+
+    def _request_with_retry(self, method, url, headers=None, json=None, phase=None, stream=False):
+        # blocking variant for lookups and other calls made outside the executor
+        attempt = 0
+        while True:
+            resp, error, retry_delay = self._attempt_request(method, url, headers, json, attempt, phase, stream)
+            if retry_delay is None:
+                return (True, resp) if error is None else (False, error)
+            if resp is not None:
+                resp.close()
+            time.sleep(retry_delay)
+            attempt += 1
+
+    #RESULTS
+
+    def default_results_path(self, file_path):
+        return f"{file_path}.results.csv"
+
+    def default_metrics_prefix(self, file_path):
+        return f"{file_path}.metrics"
+
+    def progress(self):
+        # cheap snapshot for a UI to poll while run() is going
+        executor = self.executor
+        results = self.results
+        rows_total = None
+        if self.csv_path and self.preflight_current(self.csv_path):
+            rows_total = self.preflight_report.rows
+        elif self.csv_path and self.key_scan_current(self.csv_path):
+            rows_total = self.key_scan.rows
+        return {
+            "rows_done": self.metrics.rows_done + self.resumed_rows,
+            "rows_total": rows_total,
+            "bytes_read": self.bytes_read,
+            "bytes_total": self.bytes_total,
+            "in_flight": executor.running if executor is not None else 0,
+            "waiting_retry": len(executor.delayed) if executor is not None else 0,
+            "failures": results.counts["fail"] if results is not None else 0,
+            "elapsed_seconds": time.monotonic() - self.metrics.started,
+        }
+
+    def summary(self):
+        counts = self.results.counts if self.results is not None else Counter()
+        return {
+            "total": sum(counts.values()),
+            "success": counts["success"],
+            "skipped": counts["skipped"],
+            "unchanged": counts["unchanged"],
+            "fail": counts["fail"],
+            "resumed": self.resumed_rows,
+        }
+
+    def export_results_to_csv(self, filename):
+        # the log was already written during the run; this just copies it
+        if self.results is None:
+            raise ValueError("No results to export yet.")
+        if os.path.abspath(filename) != os.path.abspath(self.results.path):
+            shutil.copyfile(self.results.path, filename)
+        print(f"Exported results log to {filename}")
+
+
+class FairGate:
+    # Global budget of concurrent requests shared by several jobs. When the
+    # budget is used up, freed slots go to the waiting jobs in turn (round
+    # robin), so a job with many queued rows can't starve the others.
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiters = {}
+        self.turns = deque()
+
+    def acquire(self, job):
+        with self.lock:
+            if self.active < self.limit and not self.turns:
+                self.active += 1
+                return
+            granted = threading.Event()
+            queue = self.waiters.setdefault(job, deque())
+            if not queue:
+                self.turns.append(job)
+            queue.append(granted)
+        granted.wait()
+
+    def release(self):
+        with self.lock:
+            if not self.turns:
+                self.active -= 1
+                return
+            # the slot passes straight to the next job in line
+            job = self.turns.popleft()
+            queue = self.waiters[job]
+            granted = queue.popleft()
+            if queue:
+                self.turns.append(job)
+            else:
+                del self.waiters[job]
+        granted.set()
+
+
+class ImportJob:
+    # One profile's run inside a JobScheduler.
+
+    def __init__(self, name, engine, csv_path):
+        self.name = name
+        self.engine = engine
+        self.csv_path = csv_path
+        self.status = "queued"
+        self.error = None
+        self.thread = None
+
+    def to_json(self):
+        data = {"name": self.name, "csv_file": self.csv_path, "endpoint": self.engine.endpoint,
+                "status": self.status}
+        if self.error:
+            data["error"] = self.error
+        if self.engine.results is not None:
+            data.update(self.engine.summary())
+            data["results_file"] = self.engine.results.path
+        return data
+
+
+class JobScheduler:
+    # Runs several job profiles at once, each with its own engine, file,
+    # endpoint and results log. All jobs share one connection pool and a
+    # FairGate of max_concurrent_requests; at most max_parallel_jobs run at
+    # the same time (default: all of them).
+
+    def __init__(self, config_data, names, config_filename=None):
+        from requests.adapters import HTTPAdapter
+        self.max_concurrent_requests = config_data.get("max_concurrent_requests", 16)
+        self.gate = FairGate(self.max_concurrent_requests)
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.max_concurrent_requests)
+        self.job_slots = threading.Semaphore(config_data.get("max_parallel_jobs") or max(1, len(names)))
+        self.jobs = []
+        for name in names:
+            job_config = profile_config(config_data, name)
+            engine = UpsertEngine(job_config, config_filename)
+            engine.job_name = name
+            engine.request_gate = self.gate
+            engine.shared_adapter = self.adapter
+            # more workers than the shared budget would only queue at the gate
+            engine.max_workers = min(engine.max_workers, self.max_concurrent_requests)
+            # nobody to ask in a batch of jobs
+            if engine.duplicate_policy == "ask":
+                engine.duplicate_policy = "update"
+            self.jobs.append(ImportJob(name, engine, job_config.get("csv_file")))
+
+    def start(self, username, password):
+        for job in self.jobs:
+            job.thread = threading.Thread(target=self.run_job, args=(job, username, password), daemon=True)
+            job.thread.start()
+
+    def run_job(self, job, username, password):
+        import requests
+        engine = job.engine
+        with self.job_slots:
+            job.status = "running"
+            try:
+                if not job.csv_path or not os.path.exists(job.csv_path):
+                    raise ValueError(f"CSV file not found: {job.csv_path}")
+                engine.login(username, password)
+                engine.fetch_api_fields()
+                if engine.duplicate_check == "prescan":
+                    scan = engine.scan_keys(job.csv_path, engine.key_column)
+                    if scan.duplicates:
+                        raise ValueError(f"{len(scan.duplicates)} duplicate values in column "
+                                         f"'{engine.key_column}':\n{scan.describe()}")
+                    engine.key_scan = scan
+                engine.run(job.csv_path)
+                job.status = "done"
+            except (ValueError, OSError, requests.exceptions.RequestException) as e:
+                job.status = "failed"
+                job.error = str(e)
+            except Exception as e:
+                # anything else would end the thread with the job still "running"
+                job.status = "failed"
+                job.error = f"Unexpected error: {e}"
+            finally:
+                engine.close_http_session()
+
+    def running(self):
+        return any(job.thread is not None and job.thread.is_alive() for job in self.jobs)
+
+    def wait(self):
+        for job in self.jobs:
+            if job.thread is not None:
+                job.thread.join()
+        self.adapter.close()
+
+    def progress(self):
+        return {job.name: dict(job.engine.progress(), status=job.status) for job in self.jobs}
+
+    def summary(self):
+        return [job.to_json() for job in self.jobs]
@@ -0,0 +1,54 @@
+from kivy.app import App
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.label import Label
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.spinner import Spinner
+
+# Widgets for the mapping screen, kept out of inv_app.py so the RecycleView
+# machinery is only imported once that screen is first shown.
+
+
+class MappingRow(RecycleDataViewBehavior, BoxLayout):
+    # One recycled "CSV header -> API field" row of the mapping screen. Only
+    # the visible rows exist as widgets; choices live in MappingApp.mapping_choices.
+
+    def __init__(self, **kwargs):
+        super().__init__(orientation='horizontal', **kwargs)
+        self.csv_header = None
+        self.refreshing = False
+        self.label = Label(size_hint_x=0.3)
+        self.spinner = Spinner(size_hint_x=0.7)
+        self.spinner.bind(text=self.on_spinner_text)
+        self.add_widget(self.label)
+        self.add_widget(self.spinner)
+
+    def refresh_view_attrs(self, rv, index, data):
+        # a recycled row gets another header's data; don't report that as a choice
+        self.refreshing = True
+        self.csv_header = data["csv_header"]
+        self.label.text = data["csv_header"]
+        self.spinner.values = data["choices"]
+        self.spinner.text = data["api_field"]
+        self.refreshing = False
+        return super().refresh_view_attrs(rv, index, data)
+
+    def on_spinner_text(self, spinner, text):
+        if not self.refreshing and self.csv_header is not None:
+            App.get_running_app().set_mapping_choice(self.csv_header, text)
+
+
+def mapping_view():
+    # a RecycleView only builds widgets for the rows on screen, so files
+    # with thousands of columns open as fast as small ones
+    view = RecycleView(viewclass=MappingRow)
+    rows_layout = RecycleBoxLayout(
+        orientation='vertical',
+        default_size=(None, 40),
+        default_size_hint=(1, None),
+        size_hint_y=None
+    )
+    rows_layout.bind(minimum_height=rows_layout.setter('height'))
+    view.add_widget(rows_layout)
+    return view